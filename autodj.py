@@ -0,0 +1,211 @@
+import collections
+import random
+import threading
+
+from mpd import CommandError
+
+import db
+from metrics import metrics
+from mpd_util import mpd_connect, mpd_idle
+import settings
+
+
+class AliasTable(object):
+    """
+    Walker's alias method: after building the table in linear time, picks
+    an index with probability proportional to its weight in constant time.
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        self.prob = [0.0] * count
+        self.alias = [0] * count
+        if not count or not total:
+            self.prob = []
+            return
+
+        scaled = [weight * count / total for weight in weights]
+        small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left is 1 give or take rounding
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    def sample(self):
+        i = int(random.random() * len(self.prob))
+        if random.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+
+
+class Window(object):
+    """The last `size` values added, with constant time membership tests"""
+
+    def __init__(self, size, values=()):
+        self.values = collections.deque()
+        self.size = size
+        self.counts = collections.Counter()
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        if not self.size:
+            return
+        if len(self.values) == self.size:
+            old = self.values.popleft()
+            self.counts[old] -= 1
+            if not self.counts[old]:
+                del self.counts[old]
+        self.values.append(value)
+        self.counts[value] += 1
+
+    def __contains__(self, value):
+        return value in self.counts
+
+
+class AutoDJ(object):
+    """
+    Keeps at least `lookahead` songs queued after the current one, so the
+    stream never runs dry.  Songs are picked at random, weighted so that
+    artists with huge back catalogues don't drown out everyone else, and
+    skipping anything played or queued within the recent windows: the same
+    song in the last `song_window` queue entries, the same artist in the
+    last `artist_window` or the same album in the last `album_window`.
+
+    The library is loaded into flat candidate pools with an alias table,
+    rebuilt only when db.library_version changes, so a pick doesn't touch
+    the database.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.load([])
+
+    def load(self, rows):
+        """Build the pools from (song id, uri, artist id, album id) rows"""
+        rows = list(rows)
+        self.song_ids = [row[0] for row in rows]
+        self.uris = [row[1] for row in rows]
+        self.artists = [row[2] for row in rows]
+        self.albums = [row[3] for row in rows]
+        self.index = dict((song_id, i) for i, song_id in enumerate(self.song_ids))
+
+        per_artist = collections.Counter(self.artists)
+        balance = settings.autodj_artist_balance
+        self.table = AliasTable([per_artist[artist] ** -balance for artist in self.artists])
+        metrics.set('autodj_pool_songs', len(self.song_ids))
+
+    def rebuild(self):
+        version = db.library_version
+        self.load(db.db.session.query(db.Song.id, db.Song.uri,
+            db.Song.artist_id, db.Song.album_id))
+        self.version = version
+
+    def windows(self):
+        """Anti-repeat windows seeded from the end of the queue"""
+        size = max(settings.autodj_song_window, settings.autodj_artist_window,
+            settings.autodj_album_window)
+        recent = [self.index[song_id] for song_id, in
+            db.db.session.query(db.Queue.song_id).order_by(db.Queue.pos.desc()).limit(size)
+            if song_id in self.index]
+        recent.reverse()
+        return (
+            Window(settings.autodj_song_window, (self.song_ids[i] for i in recent)),
+            Window(settings.autodj_artist_window, (self.artists[i] for i in recent)),
+            Window(settings.autodj_album_window, (self.albums[i] for i in recent))
+        )
+
+    def pick(self, count, windows):
+        """
+        Pick `count` pool indexes.  If the windows rule out too many tries
+        in a row they are relaxed, first to only the song window and then
+        to nothing, so a small library still gets filled.
+        """
+        songs, artists, albums = windows
+        attempts = settings.autodj_attempts
+        picks = []
+        if not len(self.table):
+            return picks
+        for n in range(count):
+            for attempt in range(attempts):
+                i = self.table.sample()
+                if self.song_ids[i] in songs:
+                    if attempt < attempts - 1:
+                        continue
+                elif attempt < attempts // 2 and (
+                        (self.artists[i] is not None and self.artists[i] in artists) or
+                        (self.albums[i] is not None and self.albums[i] in albums)):
+                    continue
+                break
+            metrics.inc('autodj_rejections_total', attempt)
+            songs.add(self.song_ids[i])
+            artists.add(self.artists[i])
+            albums.add(self.albums[i])
+            picks.append(i)
+        return picks
+
+    def fill(self, mpdc):
+        """Top up MPD's queue, returning the uris added"""
+        if self.version != db.library_version:
+            self.rebuild()
+
+        status = mpdc.status()
+        pos = status.get('song')
+        # Nothing current means the queue ran out, or was never started
+        upcoming = 0
+        if pos is not None:
+            upcoming = int(status['playlistlength']) - int(pos) - 1
+        wanted = settings.autodj_lookahead - upcoming
+        if wanted <= 0:
+            return []
+
+        picks = self.pick(wanted, self.windows())
+        if not picks:
+            return []
+        mpdc.command_list_ok_begin()
+        for i in picks:
+            mpdc.addid(self.uris[i])
+        queue_ids = mpdc.command_list_end()
+        if status.get('state') == 'stop' and pos is None:
+            mpdc.playid(int(queue_ids[0]))
+
+        metrics.inc('autodj_picks_total', len(picks))
+        return [self.uris[i] for i in picks]
+
+    def run(self):
+        mpdc = mpd_connect()
+        while True:
+            try:
+                added = self.fill(mpdc)
+                if added:
+                    print 'Auto-DJ queued {} songs'.format(len(added))
+            except CommandError as error:
+                # Most likely a song MPD no longer has, reload the pools
+                print 'Auto-DJ failed to queue: {}'.format(error)
+                self.version = None
+            finally:
+                # Don't hold a read transaction open while idling
+                db.db.session.remove()
+            mpdc = mpd_idle(mpdc, 'playlist', 'player')
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name='autodj')
+        thread.daemon = True
+        thread.start()
+
+
+autodj = AutoDJ()
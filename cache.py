@@ -0,0 +1,128 @@
+import collections
+from functools import wraps
+import gzip
+import hashlib
+import StringIO
+import threading
+
+from flask import Response, request
+
+from metrics import metrics
+import settings
+
+
+def gzipped(body):
+    output = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=output, mode='wb', mtime=0) as f:
+        f.write(body)
+    return output.getvalue()
+
+
+class ResponseCache(object):
+    """
+    Keeps rendered GET responses for data that only changes when a sync
+    loop says so.  Each response depends on one or more scopes ('library',
+    'queue') whose versions are set by the sync loops when they finish, and
+    is served from memory, gzipped if the client accepts it, until one of
+    those versions changes.  ETags are a hash of the body, so clients get a
+    304 whenever the data is unchanged, even across versions.
+
+    Until a scope has a version, responses depending on it aren't cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.versions = {}
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        metrics.gauge('response_cache', lambda: {
+            'entries': len(self.entries), 'bytes': self.size})
+
+    def update(self, scope, version):
+        """Set a scope's version, dropping responses built from older data"""
+        with self.lock:
+            if self.versions.get(scope) == version:
+                return
+            self.versions[scope] = version
+            for key, entry in self.entries.items():
+                if scope in entry['scopes']:
+                    self.drop(key)
+
+    def drop(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry['body']) + len(entry['gzip'])
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry['versions'] != versions:
+                return None
+            # Most recently used last
+            self.entries[key] = self.entries.pop(key)
+            return entry
+
+    def put(self, key, scopes, versions, response):
+        body = response.get_data()
+        entry = {
+            'scopes': scopes,
+            'versions': versions,
+            'body': body,
+            'gzip': gzipped(body),
+            'etag': hashlib.sha1(body).hexdigest(),
+            'mimetype': response.mimetype
+        }
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = entry
+            self.size += len(entry['body']) + len(entry['gzip'])
+            while self.size > self.max_bytes and self.entries:
+                self.drop(next(iter(self.entries)))
+        return entry
+
+    def respond(self, scopes, render):
+        versions = tuple(self.versions.get(scope) for scope in scopes)
+        if None in versions or request.method != 'GET':
+            return render()
+
+        key = request.full_path
+        entry = self.get(key, versions)
+        if entry:
+            metrics.inc('response_cache_total', result='hit')
+        else:
+            response = render()
+            if getattr(response, 'status_code', None) != 200 or response.is_streamed:
+                return response
+            metrics.inc('response_cache_total', result='miss')
+            entry = self.put(key, scopes, versions, response)
+
+        # Strong ETags have to differ between encodings
+        use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+        etag = entry['etag'] + ('-gzip' if use_gzip else '')
+        if etag in request.if_none_match:
+            metrics.inc('response_cache_total', result='not_modified')
+            response = Response(status=304)
+        else:
+            response = Response(entry['gzip'] if use_gzip else entry['body'],
+                mimetype=entry['mimetype'])
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+
+
+response_cache = ResponseCache(settings.cache_max_bytes)
+
+
+def cached(*scopes):
+    """Serve a view from the response cache, see ResponseCache"""
+    def wrapper(function):
+        @wraps(function)
+        def cached_fn(*args, **kwargs):
+            if not settings.cache_enabled:
+                return function(*args, **kwargs)
+            return response_cache.respond(scopes, lambda: function(*args, **kwargs))
+        return cached_fn
+    return wrapper
@@ -0,0 +1,193 @@
+"""
+Scale-out across several workers, possibly on several hosts, behind a load
+balancer.  Every worker serves the API, Socket.IO and downloads, but only
+one of them, the sync owner, mirrors MPD into the database and publishes
+events.  What the owner produces reaches every worker through a message
+bus, so each can push events to its own Socket.IO clients and expire its
+own response cache.
+
+cluster.role picks what a worker does:
+
+    all     do everything in this process, the default
+    auto    take part in electing the sync owner
+    reader  never sync, just serve
+
+The owner migrates the database, the others wait for it before preparing
+the search index, and db.clear_on_load is ignored so that a new owner
+doesn't wipe the library everyone is serving.
+
+Sync ownership is a lease on the bus that the owner keeps renewing.  The
+loopback bus only reaches the current process, so it's for single process
+deployments and tests; running several workers needs cluster.bus = redis.
+Socket.IO sessions live in the worker that created them, so the load
+balancer has to be sticky.
+"""
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+from metrics import metrics
+import settings
+
+
+class LoopbackBus(object):
+    """Delivers messages to subscribers in this process"""
+
+    def __init__(self):
+        self.subscribers = collections.defaultdict(list)
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channel, callback):
+        self.subscribers[channel].append(callback)
+
+    def start(self):
+        pass
+
+    def publish(self, channel, origin, message):
+        # Round trip through JSON so messages look like they came off a wire
+        message = json.loads(json.dumps(message))
+        for callback in list(self.subscribers[channel]):
+            callback(message, origin)
+
+    def acquire(self, name, node, ttl):
+        """Take or renew lease `name` for `ttl` seconds, True if `node` holds it"""
+        now = time.time()
+        with self.lock:
+            holder, expires = self.leases.get(name, (None, 0))
+            if holder not in (None, node) and expires > now:
+                return False
+            self.leases[name] = (node, now + ttl)
+            return True
+
+
+class RedisBus(object):
+    """Pub/sub and leases through Redis, shared by every worker using `url`"""
+
+    # Renew if we hold it, take it if nobody does
+    acquire_script = """
+        local holder = redis.call('get', KEYS[1])
+        if holder == ARGV[1] then
+            redis.call('pexpire', KEYS[1], ARGV[2])
+            return 1
+        end
+        if not holder then
+            redis.call('set', KEYS[1], ARGV[1], 'px', ARGV[2])
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, url, prefix):
+        # Optional, only multi-worker deployments need it
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+        self.subscribers = collections.defaultdict(list)
+        self.acquire_lease = self.client.register_script(self.acquire_script)
+        self.thread = None
+
+    def subscribe(self, channel, callback):
+        self.subscribers[channel].append(callback)
+
+    def start(self):
+        """Start listening, subscribe to everything first"""
+        if not self.subscribers:
+            return
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*[self.prefix + channel for channel in self.subscribers])
+        self.thread = threading.Thread(target=self.listen, args=(pubsub,), name='bus')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listen(self, pubsub):
+        for item in pubsub.listen():
+            channel = item['channel'][len(self.prefix):]
+            envelope = json.loads(item['data'])
+            for callback in self.subscribers[channel]:
+                try:
+                    callback(envelope['message'], envelope['origin'])
+                except Exception as exception:
+                    #FIXME: proper logging
+                    print 'Bus subscriber for {} failed: {}'.format(channel, exception)
+
+    def publish(self, channel, origin, message):
+        self.client.publish(self.prefix + channel,
+            json.dumps({'origin': origin, 'message': message}))
+
+    def acquire(self, name, node, ttl):
+        key = '{}lease:{}'.format(self.prefix, name)
+        return bool(self.acquire_lease(keys=[key], args=[node, int(ttl * 1000)]))
+
+
+def make_bus():
+    if settings.cluster_bus == 'redis':
+        return RedisBus(settings.cluster_redis_url, settings.cluster_prefix)
+    return LoopbackBus()
+
+
+class Cluster(object):
+    """This worker's view of the cluster, see the module docstring"""
+
+    def __init__(self, bus, role, lease_ttl):
+        self.bus = bus
+        self.role = role
+        self.lease_ttl = lease_ttl
+        self.node = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.owner = False
+        metrics.set('cluster_owner', 0)
+
+    def subscribe(self, channel, callback):
+        """Call `callback(message, origin)` for everything published on `channel`"""
+        self.bus.subscribe(channel, callback)
+
+    def publish(self, channel, message):
+        self.bus.publish(channel, self.node, message)
+
+    def start(self, on_elected):
+        """
+        Start listening on the bus and call `on_elected()` once this worker
+        becomes the sync owner, right away unless it has to be elected.
+        """
+        self.bus.start()
+        if self.role == 'all':
+            self.elected()
+            on_elected()
+        elif self.role == 'auto':
+            thread = threading.Thread(target=self.campaign, args=(on_elected,),
+                name='cluster')
+            thread.daemon = True
+            thread.start()
+
+    def elected(self):
+        self.owner = True
+        metrics.set('cluster_owner', 1)
+
+    def renew(self):
+        """Try to take or keep the sync lease, returns whether we hold it"""
+        held = self.bus.acquire('sync', self.node, self.lease_ttl)
+        if self.owner and not held:
+            # The sync threads can't be stopped part way, so leave and let
+            # the process supervisor bring us back as a reader
+            print 'Lost sync ownership, exiting'  #FIXME: proper logging
+            os._exit(1)
+        return held
+
+    def campaign(self, on_elected):
+        while True:
+            try:
+                if self.renew() and not self.owner:
+                    print 'Elected sync owner: {}'.format(self.node)
+                    self.elected()
+                    thread = threading.Thread(target=on_elected, name='sync-start')
+                    thread.daemon = True
+                    thread.start()
+            except Exception as exception:
+                print 'Sync election failed: {}'.format(exception)
+            time.sleep(self.lease_ttl / 3.0)
+
+
+cluster = Cluster(make_bus(), settings.cluster_role, settings.cluster_lease_ttl)
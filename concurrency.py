@@ -0,0 +1,38 @@
+"""
+Production async mode.  Importing Flask-SocketIO already monkey patches
+most of the standard library, so threads are greenlets on the Socket.IO
+event loop either way.  With general.async_mode = gevent the patching
+happens before anything else is imported and covers subprocesses too, and
+work that would still block the loop, like SQLite calls and hashing, goes
+through offload() to a pool of real threads.  That's what keeps requests
+answered while a big library sync is being written, see tests/load.py.
+
+This has to be imported before anything else imports threading or socket.
+"""
+import settings
+
+patched = False
+if settings.async_mode == 'gevent':
+    from gevent import monkey
+    monkey.patch_all(subprocess=True)
+    patched = True
+
+
+def offload(function, *args, **kwargs):
+    """Run a blocking call off the event loop, or just call it without gevent"""
+    if not patched:
+        return function(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(function, args, kwargs)
+
+
+def thread_lock():
+    """
+    A lock for state shared with offload()'s threads.  Waiting for a
+    patched lock from a real thread fails with LoopExit.
+    """
+    if patched:
+        from gevent.monkey import get_original
+        return get_original('thread', 'allocate_lock')()
+    import threading
+    return threading.Lock()
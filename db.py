@@ -1,24 +1,44 @@
-from flask.ext.sqlalchemy import SQLAlchemy
-from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.sql.expression import ClauseElement
+import datetime
+from Queue import Empty, Queue as WriteQueue
+import sqlite3
+import threading
+import time
 
-from mpd_util import mpd, mpd_connect
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from cluster import cluster
+from concurrency import offload
+from events import event_log
+from metrics import metrics
+from mpd_util import mpd, mpd_connect, mpd_idle
 from server import app
+import settings
 
 
 db = SQLAlchemy(app)
 
 
-def get_or_create(session, model, defaults=None, **kwargs):
-    instance = session.query(model).filter_by(**kwargs).first()
-    if instance:
-        return instance, False
-    else:
-        params = dict((k, v) for k, v in kwargs.iteritems() if not isinstance(v, ClauseElement))
-        params.update(defaults or {})
-        instance = model(**params)
-        session.add(instance)
-        return instance, True
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(connection, record):
+    """
+    WAL lets readers carry on while the sync loops write, and the busy
+    timeout makes a second writer wait its turn instead of failing.
+    """
+    if not isinstance(connection, sqlite3.Connection):
+        return
+    cursor = connection.cursor()
+    if settings.db_wal:
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout={:d}'.format(settings.db_busy_timeout))
+    cursor.close()
+
+
+def chunked(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
 
 
 class Song(db.Model):
@@ -27,21 +47,36 @@ class Song(db.Model):
     name = db.Column(db.Text)
     track = db.Column(db.Integer)
     length = db.Column(db.Integer)
+    last_modified = db.Column(db.String(32))
+    # Integrated loudness in LUFS, measured when the song is downloaded
+    loudness = db.Column(db.Float)
 
     artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'))
 
     album_id = db.Column(db.Integer, db.ForeignKey('album.id'))
     album = db.relationship('Album', backref=db.backref('songs'))
 
+    __table_args__ = (
+        # Albums in track order, and an artist's songs that aren't on one
+        db.Index('ix_song_album_track', 'album_id', 'track'),
+        db.Index('ix_song_artist_album', 'artist_id', 'album_id'),
+    )
+
 
 class Album(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.Text, unique=True, nullable=False)
+    name = db.Column(db.Text, nullable=False)
     date = db.Column(db.String(32))
 
     artist_id = db.Column(db.Integer, db.ForeignKey('artist.id'))
     artist = db.relationship('Artist', backref=db.backref('albums'))
 
+    __table_args__ = (
+        # Different artists can have albums with the same name
+        db.UniqueConstraint('name', 'artist_id', name='uq_album_name_artist'),
+        db.Index('ix_album_artist', 'artist_id'),
+    )
+
 
 class Artist(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,11 +84,14 @@ class Artist(db.Model):
     name_alpha = db.Column(db.Text)
     songs = db.relationship('Song', backref=db.backref('artist'), lazy='dynamic')
 
-    @hybrid_property
-    def non_album_songs(self):
-        #FIXME: should return actual song objects, returning IDs for ember,
-        #this should be in emberify
-        return [song.id for song in self.songs.filter(Song.album == None).all()]
+
+def non_album_songs(session, artist_ids):
+    """Ids of each artist's songs that aren't on an album, in one query"""
+    grouped = {}
+    for artist_id, song_id in session.query(Song.artist_id, Song.id).filter(
+            Song.artist_id.in_(artist_ids), Song.album_id == None).order_by(Song.id):
+        grouped.setdefault(artist_id, []).append(song_id)
+    return grouped
 
 
 class Queue(db.Model):
@@ -63,6 +101,310 @@ class Queue(db.Model):
     song = db.relationship('Song', backref=db.backref('queue'))
     played = db.Column(db.Boolean, default=False, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_queue_pos', 'pos'),
+        db.Index('ix_queue_song', 'song_id'),
+    )
+
+
+class DownloadJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), default='queued', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text)
+    uri = db.Column(db.Text)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated = db.Column(db.DateTime, default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow)
+
+
+class DownloadSource(db.Model):
+    """
+    A downloaded track, by where it came from and by the hash of what was
+    fetched, so the same track isn't downloaded and converted twice.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.Text, unique=True)
+    content_hash = db.Column(db.String(40), index=True, nullable=False)
+    uri = db.Column(db.Text, nullable=False)
+    # Bytes of the converted file, saved each time the entry is hit
+    size = db.Column(db.Integer, default=0, nullable=False)
+    hits = db.Column(db.Integer, default=0, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
+def sqlite_columns(connection, table):
+    return set(row[1] for row in connection.execute('PRAGMA table_info({})'.format(table)))
+
+
+def sqlite_schema(connection, kind, table):
+    """Names and SQL of the tables or indexes on `table`"""
+    return dict(connection.execute(
+        'SELECT name, sql FROM sqlite_master WHERE type = ? AND tbl_name = ?',
+        (kind, table)).fetchall())
+
+
+# Each step has to be safe to run again: DDL commits as it goes in SQLite,
+# so a step that fails part way has already changed the schema
+
+def add_song_columns(connection):
+    columns = sqlite_columns(connection, 'song')
+    for name, kind in [('last_modified', 'VARCHAR(32)'), ('loudness', 'FLOAT')]:
+        if name not in columns:
+            connection.execute('ALTER TABLE song ADD COLUMN {} {}'.format(name, kind))
+
+
+def rebuild_album_table(connection):
+    if 'uq_album_name_artist' in sqlite_schema(connection, 'table', 'album')['album']:
+        return
+    # SQLite can't drop the unique constraint on name, so copy the table
+    connection.execute('DROP TABLE IF EXISTS album_new')
+    connection.execute('''
+        CREATE TABLE album_new (
+            id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            date VARCHAR(32),
+            artist_id INTEGER,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_album_name_artist UNIQUE (name, artist_id),
+            FOREIGN KEY(artist_id) REFERENCES artist (id)
+        )''')
+    connection.execute('''
+        INSERT INTO album_new (id, name, date, artist_id)
+        SELECT id, name, date, artist_id FROM album''')
+    connection.execute('DROP TABLE album')
+    connection.execute('ALTER TABLE album_new RENAME TO album')
+    # Songs were matched to albums by name alone, have the next sync redo them
+    connection.execute('UPDATE song SET last_modified = NULL')
+
+
+def create_indexes(connection):
+    for table in (Song.__table__, Album.__table__, Queue.__table__):
+        existing = sqlite_schema(connection, 'index', table.name)
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+
+
+# Each step takes an existing database from one PRAGMA user_version to the
+# next, only ever append to this
+migrations = [add_song_columns, rebuild_album_table, create_indexes]
+
+
+def migrate_sqlite(engine):
+    """Bring an existing SQLite database up to date, one step at a time"""
+    with engine.connect() as connection:
+        version = connection.execute('PRAGMA user_version').scalar()
+        # A new database gets the current schema from create_all
+        if 'song' not in engine.table_names(connection=connection):
+            version = len(migrations)
+        for i in range(version, len(migrations)):
+            print 'Migrating database: {}'.format(migrations[i].__name__)
+            with connection.begin():
+                migrations[i](connection)
+            connection.execute('PRAGMA user_version = {:d}'.format(i + 1))
+        # Mark new databases too
+        connection.execute('PRAGMA user_version = {:d}'.format(len(migrations)))
+
+
+def schema_current():
+    """Whether migrate() has nothing left to do"""
+    engine = db.engine
+    if 'song' not in engine.table_names():
+        return False
+    if engine.dialect.name == 'sqlite':
+        return engine.execute('PRAGMA user_version').scalar() == len(migrations)
+    return True
+
+
+def migrate():
+    """
+    Create the schema, bringing an existing SQLite database up to date
+    first.  Other databases only get missing tables created.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        migrate_sqlite(db.engine)
+    db.create_all()
+
+
+class IdentityCache(object):
+    """
+    Maps a natural key (song uri, artist name, album artist and name) to a
+    row id so that syncing doesn't have to look up rows it has already
+    seen.  `key_column` can be a tuple of columns, making keys tuples.
+    Warmed with a single query on first use and kept up to date by the
+    functions in this module that insert or delete rows.
+    """
+
+    def __init__(self, key_column, id_column):
+        self.key_column = key_column
+        self.id_column = id_column
+        self.ids = {}
+        self.pending = {}
+        self.warmed = False
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self):
+        if isinstance(self.key_column, tuple):
+            rows = db.session.query(*self.key_column + (self.id_column,))
+            self.ids = dict((tuple(row[:-1]), row[-1]) for row in rows)
+        else:
+            self.ids = dict(db.session.query(self.key_column, self.id_column))
+        self.pending = {}
+        self.warmed = True
+
+    def get(self, key):
+        if not self.warmed:
+            self.warm()
+        row_id = self.ids.get(key)
+        if row_id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row_id
+
+    def add(self, key, row_id):
+        self.ids[key] = row_id
+
+    def add_pending(self, key, instance):
+        """Track an instance that won't have an id until the next flush"""
+        self.pending[key] = instance
+
+    def resolve(self):
+        """Move pending instances into the cache, call after a flush"""
+        for key, instance in self.pending.iteritems():
+            self.ids[key] = instance.id
+        self.pending = {}
+
+    def discard(self, key):
+        self.ids.pop(key, None)
+        self.pending.pop(key, None)
+
+    def reset(self):
+        self.ids = {}
+        self.pending = {}
+        self.warmed = False
+
+    def stats(self):
+        return {
+            'size': len(self.ids),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+song_ids = IdentityCache(Song.uri, Song.id)
+artist_ids = IdentityCache(Artist.name, Artist.id)
+album_ids = IdentityCache((Album.artist_id, Album.name), Album.id)
+identity_caches = {'songs': song_ids, 'artists': artist_ids, 'albums': album_ids}
+
+
+def identity_cache_stats():
+    return dict((name, cache.stats()) for name, cache in identity_caches.iteritems())
+
+for stat in ('size', 'hits', 'misses'):
+    metrics.gauge('identity_cache_' + stat, lambda stat=stat: dict(
+        (name, stats[stat]) for name, stats in identity_cache_stats().iteritems()),
+        label='cache')
+
+
+def reset_identity_caches():
+    for cache in identity_caches.itervalues():
+        cache.reset()
+
+
+# Bumped whenever the library changes, so whatever is built from it
+# knows to rebuild
+library_version = 0
+
+def library_changed():
+    global library_version
+    library_version += 1
+
+
+class Writer(object):
+    """
+    Runs the sync loops' writes on a single thread, so SQLite only ever
+    has one writer.  Writes that queue up while one is running are run
+    together and committed once.  A write that fails rolls back its batch,
+    so writes must be safe to run again: the others are retried one by
+    one.  Writes only flush, committing is up to the writer.  Until start()
+    is called writes run on the caller's thread.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.queue = WriteQueue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.work, name='db-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, function, *args):
+        """Run function(*args) as a write, returning its result once committed"""
+        if not self.thread or threading.current_thread() is self.thread:
+            try:
+                result = function(*args)
+                db.session.commit()
+            except:
+                db.session.rollback()
+                reset_identity_caches()
+                raise
+            return result
+        write = {'function': function, 'args': args, 'done': threading.Event()}
+        self.queue.put(write)
+        write['done'].wait()
+        if 'error' in write:
+            raise write['error']
+        return write['result']
+
+    def execute(self, writes):
+        for write in writes:
+            write['result'] = write['function'](*write['args'])
+        db.session.commit()
+
+    def work(self):
+        while True:
+            writes = [self.queue.get()]
+            while len(writes) < self.batch:
+                try:
+                    writes.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            metrics.observe('db_writer_batch', len(writes))
+            # SQLite blocks, keep it off the event loop in gevent mode
+            offload(self.write, writes)
+            for write in writes:
+                write['done'].set()
+
+    def write(self, writes):
+        try:
+            self.execute(writes)
+        except Exception:
+            db.session.rollback()
+            reset_identity_caches()
+            for write in writes:
+                try:
+                    self.execute([write])
+                except Exception as error:
+                    db.session.rollback()
+                    reset_identity_caches()
+                    write['error'] = error
+
+
+writer = Writer(settings.db_writer_batch)
+
+
+def flush_songs():
+    """Flush songs added by new_song_from_mpd_data and cache their ids"""
+    db.session.flush()
+    song_ids.resolve()
+
 
 def clear_db_songs():
     print 'Clearing songs'
@@ -70,10 +412,17 @@ def clear_db_songs():
     Album.query.filter().delete()
     Artist.query.filter().delete()
     db.session.commit()
+    reset_identity_caches()
+    library_changed()
     print 'Cleared songs'
 
 
 def new_song_from_mpd_data(song):
+    """
+    Add or update a song, and its artist and album, from MPD's metadata.
+    New songs are only added to the session, call flush_songs() to write
+    them.
+    """
     # Get or create song
     uri = song.get('file')
     assert uri
@@ -87,9 +436,17 @@ def new_song_from_mpd_data(song):
         'uri': uri,
         'name': song.get('title'),
         'track': track,
-        'length': song.get('time')
+        'length': song.get('time'),
+        'last_modified': song.get('last-modified')
     }
-    new_song = Song.query.filter(Song.uri == uri).first() or Song(**song_data)
+    song_id = song_ids.get(uri)
+    if song_id:
+        new_song = Song.query.get(song_id)
+        for key, val in song_data.iteritems():
+            setattr(new_song, key, val)
+    else:
+        new_song = Song(**song_data)
+        song_ids.add_pending(uri, new_song)
 
     # Get or create artist
     artist_name = song.get('albumartist') or song.get('artist')
@@ -101,81 +458,240 @@ def new_song_from_mpd_data(song):
         'name_alpha': song.get('albumartistsort')
     }
     if artist_name:
-        artist = Artist.query.filter(Artist.name == artist_data['name']).first() or Artist(**artist_data)
-        db.session.add(artist)
-        new_song.artist = artist
+        artist_id = artist_ids.get(artist_name)
+        if not artist_id:
+            artist = Artist(**artist_data)
+            db.session.add(artist)
+            db.session.flush()
+            artist_id = artist.id
+            artist_ids.add(artist_name, artist_id)
+        new_song.artist_id = artist_id
 
     # Get or create album
     album_data = {
         'name': song.get('album'),
-        'date': song.get('date')
+        'date': song.get('date'),
+        'artist_id': new_song.artist_id
     }
-    if new_song.artist:
-        album_data['artist'] = new_song.artist
     if album_data['name']:
-        album = Album.query.filter(Album.name == album_data['name']).first() or Album(**album_data)
-        db.session.add(album)
-        new_song.album = album
+        album_key = (album_data['artist_id'], album_data['name'])
+        album_id = album_ids.get(album_key)
+        if not album_id:
+            album = Album(**album_data)
+            db.session.add(album)
+            db.session.flush()
+            album_id = album.id
+            album_ids.add(album_key, album_id)
+        new_song.album_id = album_id
 
     db.session.add(new_song)
     return new_song
 
 
 @mpd
-def update_db_songs(mpdc=None):
-    songs = mpdc.listallinfo()
-    total = len(songs)
-    num = 0
-    for song in songs:
+def update_db_songs(mpdc=None, batch_size=None):
+    """
+    Sync the song table with MPD's library.  Only songs whose
+    last-modified time differs from what was stored on the last sync are
+    written, songs missing from MPD are removed, and changes are flushed
+    every `batch_size` rows and committed once by the writer.  Returns the
+    ids of the songs added, updated and removed.
+    """
+    batch_size = batch_size or settings.db_sync_batch_size
+    return writer.run(sync_songs, mpdc.listallinfo(), batch_size)
+
+
+def sync_songs(library, batch_size):
+    synced = dict((uri, (song_id, last_modified)) for uri, song_id, last_modified in
+        db.session.query(Song.uri, Song.id, Song.last_modified))
+    added = []
+    updated = []
+
+    pending = 0
+    for song in library:
         # listallinfo returns directories, ignore them
-        if not song.get('file'):
+        uri = song.get('file')
+        if not uri:
             continue
+
+        if uri in synced:
+            if synced.pop(uri)[1] == song.get('last-modified'):
+                continue
+            updated.append(uri)
+        else:
+            added.append(uri)
+
         new_song_from_mpd_data(song)
-        num += 1
-        print 'Added song {}/{}'.format(num, total)  #FIXME: proper logging
-    db.session.commit()
+        pending += 1
+        if pending >= batch_size:
+            flush_songs()
+            pending = 0
+
+    # Whatever is left over is no longer in MPD
+    removed = list(synced)
+    removed_ids = [synced[uri][0] for uri in removed]
+    for uris in chunked(removed, batch_size):
+        Song.query.filter(Song.uri.in_(uris)).delete(synchronize_session=False)
+    for uri in removed:
+        song_ids.discard(uri)
+
+    flush_songs()
+    if added or updated or removed:
+        library_changed()
+    return {
+        'added': [song_ids.ids.get(uri) for uri in added],
+        'updated': [song_ids.ids.get(uri) for uri in updated],
+        'removed': removed_ids
+    }
 
 
 def clear_db_queue():
-    # For now just clear the queue data and reload it
-    for queue in Queue.query.all():
-        db.session.delete(queue)
+    Queue.query.delete(synchronize_session=False)
+
+
+class QueueMirror(object):
+    """
+    Mirrors MPD's queue into the Queue table.  The playlist version seen on
+    the last sync is remembered so that only the entries MPD reports as
+    changed since then (plchanges) are rewritten, instead of the whole
+    queue.
+    """
+
+    def __init__(self):
+        self.version = None
+
+    def sync(self, mpdc):
+        status = mpdc.status()
+        version = int(status['playlist'])
+        length = int(status['playlistlength'])
+        current_pos = status.get('song')
+        if current_pos is not None:
+            current_pos = int(current_pos)
+
+        if self.version is None:
+            changes = mpdc.plchanges(0)
+        elif version != self.version:
+            changes = mpdc.plchanges(self.version)
+        else:
+            changes = []
+
+        rows, touched = writer.run(self.write, changes, length, current_pos,
+            self.version is None)
+        self.version = version
+        changed_ids = set(row['id'] for row in rows)
+
+        entry = lambda row: {'id': row['id'], 'pos': row['pos'], 'song': row['song_id']}
+        return {
+            'version': version,
+            'length': length,
+            'inserted': [entry(row) for row in rows if row['id'] not in touched],
+            'moved': [entry(row) for row in rows if row['id'] in touched],
+            'deleted': list(touched - changed_ids),
+            'player': {
+                'state': status.get('state'),
+                'pos': current_pos,
+                'queue': status.get('songid') and int(status['songid']),
+                'elapsed': status.get('elapsed') and float(status['elapsed'])
+            }
+        }
+
+    def write(self, changes, length, current_pos, reset):
+        """Apply plchanges to the Queue table, returning the rows and touched ids"""
+        if reset:
+            clear_db_queue()
+
+        rows = [{
+            'id': int(entry['id']),
+            'pos': int(entry['pos']),
+            'song_id': song_ids.get(entry.get('file')),
+            'played': False
+        } for entry in changes]
+
+        # Entries past the end of the queue were removed.  Changed entries
+        # are rewritten, along with whatever used to sit where they are now.
+        touched = set()
+        def delete(criterion):
+            touched.update(queue_id for queue_id, in
+                db.session.query(Queue.id).filter(criterion))
+            Queue.query.filter(criterion).delete(synchronize_session=False)
+
+        delete(Queue.pos >= length)
+        for chunk in chunked(rows, settings.db_sync_batch_size):
+            delete(db.or_(
+                Queue.id.in_([row['id'] for row in chunk]),
+                Queue.pos.in_([row['pos'] for row in chunk])
+            ))
+            db.session.execute(Queue.__table__.insert(), chunk)
+
+        # Current song may have changed without the queue changing
+        if current_pos is None:
+            Queue.query.update({Queue.played: False}, synchronize_session=False)
+        else:
+            Queue.query.update({Queue.played: Queue.pos < current_pos},
+                synchronize_session=False)
+        return rows, touched
+
+
+queue_mirror = QueueMirror()
 
 
 @mpd
 def update_db_queue(mpdc=None):
-    queue = mpdc.playlistinfo()
-    current_song_pos = mpdc.currentsong().get('pos')
-    if current_song_pos != None:
-        current_song_pos = int(current_song_pos)
-
-    for song in queue:
-        queue = {
-            'id': song.get('id'),
-            'song': Song.query.filter(Song.uri == song.get('file')).one(),
-            'pos': int(song.get('pos')),
-            'played': int(song.get('pos')) < current_song_pos
-        }
-        get_or_create(db.session, Queue, **queue)
+    return queue_mirror.sync(mpdc)
 
-    db.session.commit()
+
+def publish_changes(kind, changes, keys):
+    """Broadcast a delta, or just ask clients to reload if it's huge"""
+    if not any(changes[key] for key in keys):
+        return
+    if sum(len(changes[key]) for key in keys) > settings.events_max_delta:
+        changes = dict((key, val) for key, val in changes.iteritems() if key not in keys)
+        changes['reload'] = True
+    event_log.publish(kind, changes)
+
+
+def publish_version(scope, version):
+    """Let every worker's response cache know the data behind `scope` changed"""
+    cluster.publish('versions', {'scope': scope, 'version': version})
 
 
 #FIXME: proper logging instead of print
-@mpd
-def update_queue_on_change(mpdc=None):
+def update_queue_on_change():
+    mpdc = mpd_connect()
+    player = None
     while True:
         print 'Updating db (queue)'
-        clear_db_queue()
-        update_db_queue()
-        print 'Updated db (queue)'
-        mpdc.idle('playlist')
+        with metrics.timer('sync_cycle_seconds', loop='queue'):
+            changes = update_db_queue(mpdc=mpdc)
+        rows = len(changes['inserted']) + len(changes['moved']) + len(changes['deleted'])
+        metrics.inc('sync_rows_total', rows, loop='queue')
+        print 'Updated db (queue): {} entries changed'.format(rows)
 
-@mpd
-def update_songs_on_change(mpdc=None):
+        publish_changes('queue', dict((key, val) for key, val in changes.iteritems()
+            if key != 'player'), ('inserted', 'moved', 'deleted'))
+        if changes['player'] != player:
+            player = changes['player']
+            event_log.publish('player', player)
+        # Played flags change with the current song, not just the playlist
+        publish_version('queue', (changes['version'], changes['player']['pos']))
+
+        mpdc = mpd_idle(mpdc, 'playlist', 'player')
+
+
+def update_songs_on_change():
+    mpdc = mpd_connect()
     while True:
         print 'Updating db (songs)'
-        update_db_songs()
-        print 'Updated db (songs)'
-        mpdc = mpd_connect()   #FIXME: proper timeout handling
-        mpdc.idle('database')
+        start = time.time()
+        changes = update_db_songs()
+        seconds = time.time() - start
+        rows = sum(len(ids) for ids in changes.itervalues())
+        metrics.observe('sync_cycle_seconds', seconds, loop='songs')
+        metrics.inc('sync_rows_total', rows, loop='songs')
+        metrics.set('sync_rows_per_second', rows / seconds if seconds else 0, loop='songs')
+        print 'Updated db (songs): {} added, {} updated, {} removed'.format(
+            len(changes['added']), len(changes['updated']), len(changes['removed']))
+        print 'Identity caches: {}'.format(identity_cache_stats())
+        publish_changes('library', changes, ('added', 'updated', 'removed'))
+        publish_version('library', (mpdc.stats().get('db_update'), library_version))
+        mpdc = mpd_idle(mpdc, 'database')
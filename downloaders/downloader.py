@@ -1,7 +1,59 @@
 import re
+import time
+
+import settings
+
+
+def format_size(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f}GiB'.format(size)
+
+
+class progress(object):
+    """
+    Reports download progress through `emit`, at most once every
+    `interval` seconds so a fast download doesn't flood the client.
+    """
+    def __init__(self, emit, interval=None):
+        self.emit = emit
+        self.interval = settings.progress_interval if interval is None else interval
+        self.last = 0
+
+    def update(self, done, total=None, force=False):
+        now = time.time()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        if total:
+            msg = '{:.1f}% of {}'.format(100.0 * done / total, format_size(total))
+        else:
+            msg = '{} downloaded'.format(format_size(done))
+        self.emit('response', {'msg': msg, 'done': done, 'total': total})
+
 
 class downloader(object):
-    def download(self, url, target, emit):
+    def source_id(self, url):
+        """
+        A key naming the track behind `url` however it is linked, e.g.
+        'youtube:<video id>', or None if it can't be told from the URL.
+        """
+        return None
+
+    def expand(self, url):
+        """
+        The URLs of the tracks behind `url`, which is a list of one unless
+        it points to a playlist, channel or set.
+        """
+        return [url]
+
+    def fetch(self, url, target, emit):
+        """
+        Download the source audio for `url` into the `target` directory,
+        as-is without transcoding, and return its filename.
+        """
         raise NotImplementedError
 
     def __unicode__(self):
@@ -0,0 +1,60 @@
+import threading
+
+
+def item_emitter(emit, index, total):
+    """Tag progress from one item of a set with its position in the set"""
+    def item_emit(event, data=None):
+        data = dict(data or {}, item=index + 1, total=total)
+        if 'msg' in data:
+            data['msg'] = '[{}/{}] {}'.format(index + 1, total, data['msg'])
+        emit(event, data)
+    return item_emit
+
+
+def fetch_all(items, handler, parallelism, emit, fatal=()):
+    """
+    Call handler(item, emit) for every item, at most `parallelism` at a
+    time, each with an emit that tags progress with the item's position.
+    An item failing doesn't stop the rest, unless it raises one of the
+    `fatal` exceptions, which stops new items from starting and is raised
+    again once the running ones are done.
+
+    Returns the results and the exceptions in item order, with None for
+    the items that failed or succeeded respectively.
+    """
+    total = len(items)
+    results = [None] * total
+    errors = [None] * total
+    pending = list(reversed(list(enumerate(items))))
+    lock = threading.Lock()
+    stopped = []
+
+    def work():
+        while True:
+            with lock:
+                if stopped or not pending:
+                    return
+                index, item = pending.pop()
+            try:
+                results[index] = handler(item, item_emitter(emit, index, total))
+            except fatal as exception:
+                with lock:
+                    stopped.append(exception)
+            except Exception as exception:
+                errors[index] = exception
+                try:
+                    item_emitter(emit, index, total)('response', {'msg': str(exception)})
+                except fatal as exception:
+                    with lock:
+                        stopped.append(exception)
+
+    threads = [threading.Thread(target=work) for i in range(min(parallelism, total))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if stopped:
+        raise stopped[0]
+    return results, errors
@@ -1,16 +1,89 @@
-from downloader import downloader
-import json, requests, re
+from downloader import downloader, progress
+import json, os, requests, re, urlparse
+import settings
+
+# Shared so downloads reuse pooled connections to the API and the CDN
+session = requests.Session()
+session.headers['User-Agent'] = 'Mozilla/5.0'
 
 class soundcloud_downloader(downloader):
     regex = re.compile("https?://(www\.)?soundcloud.com/.*")
+    api_url = 'https://api.soundcloud.com'
+    unsafe = re.compile(r'[^\w\- .]+', re.UNICODE)
+
+    def source_id(self, url):
+        # Tracks are /<user>/<track>, the numeric id needs an API call
+        path = urlparse.urlparse(url).path.strip('/').lower()
+        if path.count('/') != 1:
+            return None
+        return 'soundcloud:' + path
+
+    def api(self, path, **params):
+        params['client_id'] = settings.soundcloud_client_id
+        response = session.get(self.api_url + path, params=params,
+            timeout=settings.soundcloud_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def expand(self, url):
+        parts = urlparse.urlparse(url).path.strip('/').split('/')
+        # /<user>/<track>, anything else is a set or a user's page
+        if len(parts) == 2 and parts[1] not in ('sets', 'tracks'):
+            return [url]
+        resolved = self.api('/resolve.json', url=url)
+        if resolved.get('kind') == 'playlist':
+            tracks = resolved.get('tracks', [])
+        elif resolved.get('kind') == 'user':
+            tracks = self.api('/users/{}/tracks.json'.format(resolved['id']))
+        else:
+            return [url]
+        return [track['permalink_url'] for track in tracks]
+
+    def fetch(self, url, target, emit):
+        track = self.api('/resolve.json', url=url)
+        if track.get('kind') != 'track' or not track.get('stream_url'):
+            raise Exception('Not a streamable track')
 
-    def download(self, url, target, emit):
-        headers = {
-            'User-Agent': 'Mozilla/5.0'
-        }
-        page = requests.get(url, headers=headers)
-        raise NotImplementedError
+        name = self.unsafe.sub('_', u'{}-{}'.format(track['title'], track['id']))
+        filename = os.path.join(target, name + '.mp3')
+        if os.path.exists(filename):
+            emit('response', {'msg': 'Song already downloaded, skipping download'})
+            return filename
+
+        # Pick up where an interrupted download stopped
+        partial = filename + '.part'
+        done = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = {'Range': 'bytes={}-'.format(done)} if done else {}
+        response = session.get(track['stream_url'], headers=headers, stream=True,
+            params={'client_id': settings.soundcloud_client_id},
+            timeout=settings.soundcloud_timeout)
+        try:
+            if response.status_code == 416:
+                # The partial file is no good, start again
+                os.remove(partial)
+                return self.fetch(url, target, emit)
+            response.raise_for_status()
+            if response.status_code != 206:
+                done = 0
+
+            length = response.headers.get('Content-Length')
+            total = done + int(length) if length else None
+            emit('response', {'msg': 'Resuming download' if done else 'Downloading song'})
+            reporter = progress(emit)
+            with open(partial, 'ab' if done else 'wb') as f:
+                for chunk in response.iter_content(settings.soundcloud_chunk_size):
+                    f.write(chunk)
+                    done += len(chunk)
+                    reporter.update(done, total)
+        finally:
+            response.close()
+
+        if total and done < total:
+            raise Exception('Download stopped after {} of {} bytes'.format(done, total))
+        reporter.update(done, total, force=True)
+        os.rename(partial, filename)
+        emit('response', {'msg': 'Download finished'})
+        return filename
 
     def __unicode__(self):
         return "soundcloud-dl"
-
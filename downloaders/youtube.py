@@ -1,63 +1,82 @@
-from downloader import downloader
-import commands
+from downloader import downloader, progress
 import re
-import sys
-import pexpect
+import urlparse
+import youtube_dl
+from youtube_dl.utils import PagedList
 
 class youtube_downloader(downloader):
     regex = re.compile('https?://(www\.)?youtube.com/.*')
 
-    version_map = {
-        '2014.06.19': {
-            'downloading': '(^.*\r\n)*\[download\] Destination:',
-            'skipping': '(.*\r\n)*.*Post-process file (?P<file>.*) exists, skipping',
-            'percent': '(.*\r\n)*.*\[download\] *(?P<perc>[0-9.]+% of .* at .* ETA [0-9:]*)',
-            'downloaded': '(.*\r\n)*\[(ffmpeg|avconv)\] Destination: (?P<file>.*)\r\n'
-        }
-    }
-
-    default_version = '2014.06.19'
-
-    def download(self, url, target, emit):
-        template = '{}/%(title)s-%(id)s.%(ext)s'.format(target)
-        child = pexpect.spawn("youtube-dl -v --keep --extract-audio --audio-format mp3 \
-            --no-post-overwrites -o '{}' ".format(template) + url)
-        child.logfile = sys.stdout
-
-        # Get the output expected for this version of youtube-dl
-        version = commands.getoutput('youtube-dl --version')
-        expect = self.version_map.get(version)
-        if not expect:
-            expect = self.version_map.get(self.default_version)
-
-        # Either song exists or it is downloaded
-        i = child.expect([
-            re.compile(expect['downloading']),
-            re.compile(expect['skipping']),
-        ])
-
-        # youtube-dl is downloading
-        if i == 0:
-            emit('response', {'msg': 'Downloading song'})
-            downloading = True
-            while downloading:
-
-                # Look for percent complete updates or transcoding message
-                j = child.expect([
-                    re.compile(expect['percent']),
-                    re.compile(expect['downloaded'])
-                ])
-                if j == 0:
-                    emit('response', {'msg': child.match.group('perc')})
-                elif j == 1:
-                    emit('response', {'msg': 'Download and conversion finished'})
-                    downloading = False
-
-        elif i == 1:
-            emit('response', {'msg': 'Song already exists, skipping download'})
-
-        filename = child.match.group('file')
-        return filename
+    playlist_regex = re.compile('[?&]list=|/(playlist|channel|user|c)/')
+    video_url = 'https://www.youtube.com/watch?v={}'
+
+    def client(self, params=None):
+        params = dict(params or {}, quiet=True, noprogress=True)
+        client = youtube_dl.YoutubeDL(params)
+        client.add_default_info_extractors()
+        return client
+
+    def source_id(self, url):
+        video = urlparse.parse_qs(urlparse.urlparse(url).query).get('v')
+        if not video:
+            return None
+        return 'youtube:' + video[0]
+
+    def expand(self, url):
+        if not self.playlist_regex.search(url):
+            return [url]
+        # Only list the entries, don't resolve each video
+        client = self.client()
+        info = client.extract_info(url, download=False, process=False)
+        while info.get('_type') in ('url', 'url_transparent'):
+            info = client.extract_info(info['url'], download=False,
+                ie_key=info.get('ie_key'), process=False)
+        if info.get('_type') != 'playlist':
+            return [url]
+
+        entries = info.get('entries')
+        # Channels and users come as a PagedList, which can only be sliced
+        if isinstance(entries, PagedList):
+            entries = entries.getslice()
+        urls = []
+        for entry in entries or []:
+            video = entry.get('id') or entry.get('url')
+            if not video:
+                continue
+            urls.append(video if video.startswith('http') else self.video_url.format(video))
+        return urls
+
+    def fetch(self, url, target, emit):
+        template = u'{}/%(title)s-%(id)s.%(ext)s'.format(target)
+        reporter = progress(emit)
+        state = {'downloading': False, 'filename': None}
+
+        def hook(status):
+            if status['status'] == 'downloading':
+                if not state['downloading']:
+                    state['downloading'] = True
+                    emit('response', {'msg': 'Downloading song'})
+                reporter.update(status.get('downloaded_bytes', 0),
+                    status.get('total_bytes') or status.get('total_bytes_estimate'))
+            elif status['status'] == 'finished':
+                state['filename'] = status['filename']
+
+        client = self.client({
+            'format': 'bestaudio/best',
+            'outtmpl': template,
+            'noplaylist': True
+        })
+        client.add_progress_hook(hook)
+        client.extract_info(url, download=True)
+
+        if not state['filename']:
+            raise Exception('youtube-dl did not download anything')
+        # youtube-dl reports a file it already has as finished straight away
+        if state['downloading']:
+            emit('response', {'msg': 'Download finished'})
+        else:
+            emit('response', {'msg': 'Song already downloaded, skipping download'})
+        return state['filename']
 
     def __unicode__(self):
         return "youtube-dl"
@@ -1,77 +1,113 @@
-import copy
 import sqlalchemy
 
-def emberify(collection, model=None, many=True):
 
-    def emberify_record(record=None):
+serializers = {}
+
+
+class EmberSerializer(object):
+    """
+    Turns rows of a model into the format Ember's RESTAdapter expects:
+    {
+      posts: [
+        {id: 1, user: 27, ...}
+      ],
+      users: {id: 27, ...} // Optional sideloading
+    }
+
+    The model's columns and relationships are inspected once, when the
+    serializer is created, so serializing a record is just a few dict
+    operations.  Records are built straight from column tuples (see
+    `query` and `serialize`), with relationships and extras loaded per
+    page by one grouped query each rather than per record.
+    """
+
+    def __init__(self, model, singular, plural):
+        self.model = model
+        self.singular = singular
+        self.plural = plural
+
+        mapper = sqlalchemy.orm.class_mapper(model)
+        self.columns = [prop.columns[0] for prop in mapper.column_attrs]
+
+        # Relationships referencing something else store the other id in a
+        # column of ours, relationships referenced by something else store
+        # our id in a column of theirs
+        self.to_one = []
+        self.to_many = []
+        for rel in mapper.relationships:
+            id_column = next(iter(rel.local_columns))
+            if id_column.primary_key:
+                remote = next(iter(rel.remote_side))
+                self.to_many.append((rel.key, rel.mapper.class_, remote))
+            else:
+                self.to_one.append((rel.key, id_column.name, rel.mapper.class_))
+
+        renames = dict((name, key) for key, name, other in self.to_one)
+        self.keys = [renames.get(column.key, column.key) for column in self.columns]
+
+        # Computed fields, name -> function(session, ids) -> {id: value}
+        self.extras = {}
+
+    def extra(self, name, function):
+        self.extras[name] = function
+
+    def query(self, session):
+        return session.query(*self.columns)
+
+    def records(self, session, rows):
+        records = [dict(zip(self.keys, row)) for row in rows]
+        if not records:
+            return records
+
+        ids = [record['id'] for record in records]
+        for key, other, remote in self.to_many:
+            grouped = {}
+            for chunk in chunks(ids):
+                related = session.query(remote, other.id).filter(remote.in_(chunk))
+                for owner_id, other_id in related:
+                    grouped.setdefault(owner_id, []).append(other_id)
+            for record in records:
+                record[key] = grouped.get(record['id'], [])
+
+        for name, function in self.extras.iteritems():
+            values = {}
+            for chunk in chunks(ids):
+                values.update(function(session, chunk))
+            for record in records:
+                record[name] = values.get(record['id'], [])
+
+        return records
+
+    def serialize(self, session, rows, many=True, sideload=()):
         """
-        Ember expects the reference field to have the ID.  What is being
-        recieved by restless is the reference field has the de-referenced data
-        and the field that stores the id to the reference is being thrown in as
-        well, which causes errors.
-
-        Ember expects:
-        {
-          posts: [
-            {id: 1, user: 27, ...}
-          ],
-          users: {id: 27, ...} // Optional sideloading
-        }
-        We're getting:
-        {
-          posts: [
-            {id: 1, user_id: 27, user: {id: 27, name: ...} ...}
-        }
+        Build the Ember response for column tuples from `query`.
+        `sideload` names to-one relationships whose records should be
+        included alongside.
         """
+        records = self.records(session, rows)
+        if many:
+            result = {self.plural: records}
+        else:
+            result = {self.singular: records[0] if records else None}
+
+        for key, name, other in self.to_one:
+            if key not in sideload:
+                continue
+            serializer = serializers[other]
+            other_ids = set(record[key] for record in records if record[key] is not None)
+            other_rows = []
+            for chunk in chunks(list(other_ids)):
+                other_rows.extend(serializer.query(session).filter(other.id.in_(chunk)))
+            result[serializer.plural] = serializer.records(session, other_rows)
+
+        return result
+
+
+def chunks(ids, size=500):
+    for i in xrange(0, len(ids), size):
+        yield ids[i:i + size]
+
 
-        # Go through each column and see if there's a foreign key involved
-        del_columns = []
-        for key, val in record.iteritems():
-            column = model.__dict__.get(key)
-
-            # Some sort of relationship
-            property = getattr(column, 'property', None)
-            if property and type(property) is sqlalchemy.orm.relationships.RelationshipProperty:
-                id_column = next(iter(column.property.local_columns))
-
-                # This model is being referenced by something else
-                if id_column.primary_key:
-                    #TODO: sideload
-                    other_ids = []
-                    for other_item in val:
-                        #FIXME: assuming id is primary key
-                        other_ids.append(other_item['id'])
-                    record[key] = other_ids
-
-                # This model is referencing something else
-                else:
-                    #TODO: Sideload
-                    record[key] = record[id_column.name]
-                    del_columns.append(id_column.name)
-
-        #TODO: sideload instead of delete
-        for col in del_columns:
-            del(record[col])
-
-    def emberify_single(result=None, **kw):
-        emberify_record(result)
-        result[collection] = copy.deepcopy(result)
-        for key in result.keys():
-            if key != collection:
-                del(result[key])
-
-    def emberify_many(result=None, **kw):
-        # Remove pagination
-        for key in result.keys():
-            if key != 'objects':
-                del(result[key])
-        result[collection] = result['objects']
-        del(result['objects'])
-
-        # Handle foreign keys
-        for item in result[collection]:
-            emberify_record(item)
-
-    if many:
-        return emberify_many
-    return emberify_single
+def register(model, singular, plural):
+    serializers[model] = EmberSerializer(model, singular, plural)
+    return serializers[model]
@@ -0,0 +1,65 @@
+import collections
+import threading
+import uuid
+
+import settings
+
+
+class EventLog(object):
+    """
+    Numbers every event broadcast to clients and remembers the most recent
+    ones, so a client that reconnects can ask for everything after the last
+    sequence number it saw instead of reloading.  `send(event)` delivers an
+    event to connected clients.
+
+    Numbering starts over whenever the server restarts, so every log has an
+    epoch and sequence numbers from another epoch mean nothing.
+
+    Only the sync owner publishes, other workers receive() its events as
+    they come off the bus and keep the same numbering and epoch.
+    """
+
+    def __init__(self, size):
+        self.events = collections.deque(maxlen=size)
+        self.seq = 0
+        self.epoch = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.send = None
+
+    def publish(self, kind, data):
+        with self.lock:
+            self.seq += 1
+            event = {'seq': self.seq, 'epoch': self.epoch, 'type': kind, 'data': data}
+            self.events.append(event)
+        if self.send:
+            self.send(event)
+        return event
+
+    def receive(self, event):
+        """Keep an event numbered elsewhere"""
+        with self.lock:
+            # Missed some, or a new owner started counting again: whatever
+            # we kept can't be replayed as is
+            epoch = event.get('epoch', self.epoch)
+            if epoch != self.epoch or event['seq'] != self.seq + 1:
+                self.events.clear()
+            self.epoch = epoch
+            self.seq = event['seq']
+            self.events.append(event)
+
+    def since(self, seq, epoch=None):
+        """
+        Events after `seq`, or None if they are no longer all kept or `seq`
+        was never ours: from another `epoch`, or ahead of us
+        """
+        with self.lock:
+            if (epoch is not None and epoch != self.epoch) or seq > self.seq:
+                return None
+            if seq == self.seq:
+                return []
+            if not self.events or self.events[0]['seq'] > seq + 1:
+                return None
+            return [event for event in self.events if event['seq'] > seq]
+
+
+event_log = EventLog(settings.events_buffer)
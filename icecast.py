@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+import urlparse
+
+from lxml import etree
+import requests
+
+
+class IcecastStats(object):
+    """
+    Polls Icecast's status in the background and keeps the latest listener
+    counts, per mount and in total, in memory.  Understands both
+    status-json.xsl and the XML from /admin/stats.  Stats older than `ttl`
+    seconds are treated as unknown, and `on_change(stats)` is called
+    whenever they change.
+    """
+
+    def __init__(self, url, interval, ttl, timeout, auth=None, on_change=None):
+        self.url = url
+        self.interval = interval
+        self.ttl = ttl
+        self.timeout = timeout
+        self.on_change = on_change
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.lock = threading.Lock()
+        self.stats = None
+        self.fetched = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.poll, name='icecast')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def poll(self):
+        while True:
+            # Nothing may end the poller, a read timeout part way through
+            # the body isn't even a RequestException
+            try:
+                self.refresh()
+            except Exception as exception:
+                print 'Icecast poll failed: {}'.format(exception)  #FIXME: proper logging
+            time.sleep(self.interval)
+
+    def refresh(self):
+        try:
+            stats = self.fetch()
+        except (requests.RequestException, ValueError, KeyError, etree.XMLSyntaxError) as exception:
+            print 'Icecast status unavailable: {}'.format(exception)  #FIXME: proper logging
+            return
+
+        with self.lock:
+            changed = stats != self.stats
+            self.stats = stats
+            self.fetched = time.time()
+        if changed and self.on_change:
+            try:
+                self.on_change(stats)
+            except Exception as exception:
+                print 'Icecast change handler failed: {}'.format(exception)  #FIXME: proper logging
+
+    def fetch(self):
+        response = self.session.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        if response.text.lstrip().startswith('<'):
+            return self.parse_xml(response.content)
+        return self.parse_json(response.text)
+
+    def parse_json(self, text):
+        sources = json.loads(text)['icestats'].get('source', [])
+        # A single source isn't wrapped in a list
+        if isinstance(sources, dict):
+            sources = [sources]
+
+        mounts = {}
+        for source in sources:
+            mount = urlparse.urlparse(source.get('listenurl', '')).path
+            mounts[mount] = {
+                'listeners': int(source.get('listeners') or 0),
+                'bitrate': source.get('bitrate') or source.get('audio_bitrate'),
+                'title': source.get('title')
+            }
+        return self.summarize(mounts)
+
+    def parse_xml(self, content):
+        tree = etree.fromstring(content)
+        mounts = {}
+        for source in tree.iterfind('source'):
+            mounts[source.get('mount')] = {
+                'listeners': int(source.findtext('listeners') or 0),
+                'bitrate': source.findtext('bitrate'),
+                'title': source.findtext('title')
+            }
+        return self.summarize(mounts)
+
+    def summarize(self, mounts):
+        return {
+            'listeners': sum(mount['listeners'] for mount in mounts.itervalues()),
+            'mounts': mounts
+        }
+
+    def current(self):
+        with self.lock:
+            if self.stats is None or time.time() - self.fetched > self.ttl:
+                return None
+            return self.stats
@@ -0,0 +1,146 @@
+import Queue
+import threading
+
+import db
+import settings
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobQueue(object):
+    """
+    Runs download jobs on a bounded pool of worker threads.  Jobs are kept
+    in the DownloadJob table, so anything queued or running when the server
+    stopped is picked up again by start().
+
+    `handler(url, emit)` does the actual work and returns the MPD uri of
+    the downloaded song.  `publish(job_id, event, data)` sends progress to
+    whoever is subscribed to the job.
+    """
+
+    active = ('queued', 'running')
+
+    def __init__(self, workers, handler, publish):
+        self.workers = workers
+        self.handler = handler
+        self.publish = publish
+        self.queue = Queue.Queue()
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self, resume=True):
+        """Start the workers, picking up jobs left unfinished if `resume`"""
+        if resume:
+            for job in db.DownloadJob.query.filter(db.DownloadJob.status.in_(self.active)):
+                job.status = 'queued'
+                self.queue.put(job.id)
+            db.db.session.commit()
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name='download-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, url):
+        job = db.DownloadJob(url=url)
+        db.db.session.add(job)
+        db.db.session.commit()
+        self.queue.put(job.id)
+        return job.id
+
+    def get(self, job_id):
+        try:
+            return db.DownloadJob.query.get(int(job_id))
+        except (TypeError, ValueError):
+            return None
+
+    def status(self, job_id):
+        job = self.get(job_id)
+        if not job:
+            return None
+        return {
+            'job': job.id,
+            'url': job.url,
+            'status': job.status,
+            'attempts': job.attempts,
+            'error': job.error,
+            'uri': job.uri
+        }
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if not job or job.status not in self.active:
+            return False
+        # Running jobs stop the next time they report progress
+        with self.lock:
+            self.cancelled.add(job.id)
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            db.db.session.commit()
+        return True
+
+    def retry(self, job_id):
+        job = self.get(job_id)
+        if not job or job.status not in ('failed', 'cancelled'):
+            return False
+        with self.lock:
+            self.cancelled.discard(job.id)
+        job.status = 'queued'
+        job.error = None
+        db.db.session.commit()
+        self.queue.put(job.id)
+        return True
+
+    def emitter(self, job_id):
+        def emit(event, data=None):
+            with self.lock:
+                if job_id in self.cancelled:
+                    raise JobCancelled('Download cancelled')
+            data = dict(data or {}, job=job_id)
+            self.publish(job_id, event, data)
+        return emit
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self.run(job_id)
+            finally:
+                db.db.session.remove()
+
+    def run(self, job_id):
+        job = db.DownloadJob.query.get(job_id)
+        if not job or job.status != 'queued':
+            return
+        job.status = 'running'
+        job.attempts += 1
+        db.db.session.commit()
+
+        try:
+            job.uri = self.handler(job.url, self.emitter(job_id))
+            job.status = 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as exception:
+            job.error = str(exception)
+            self.publish(job_id, 'response', {'msg': job.error, 'job': job_id})
+            if job.attempts < settings.download_max_attempts:
+                job.status = 'queued'
+            else:
+                job.status = 'failed'
+
+        with self.lock:
+            self.cancelled.discard(job_id)
+        db.db.session.commit()
+
+        self.publish(job_id, 'response', {
+            'msg': 'Job {}'.format(job.status), 'job': job_id, 'status': job.status
+        })
+        if job.status == 'queued':
+            self.queue.put(job_id)
+        else:
+            self.publish(job_id, 'disconnect', {'job': job_id})
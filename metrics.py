@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+import collections
+import cProfile
+import pstats
+import StringIO
+import time
+
+from concurrency import thread_lock
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(val).replace('"', '\\"'))
+        for key, val in labels) + '}'
+
+
+class Metrics(object):
+    """
+    Counters, timers and gauges for the hot paths, rendered in Prometheus'
+    text format.  Each metric is keyed by its name and labels.  Gauges can
+    also be callbacks returning {label value: value}, evaluated on render.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # Offloaded writes count things too
+        self.lock = thread_lock()
+        self.counters = {}
+        self.timers = {}
+        self.gauges = {}
+        self.callbacks = {}
+
+    def key(self, name, labels):
+        return name, tuple(sorted(labels.iteritems()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            count, total, worst = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(worst, seconds))
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def gauge(self, name, function, label='stat'):
+        self.callbacks[name] = (function, label)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def render(self):
+        lines = []
+
+        def add(kind, name, samples):
+            name = self.prefix + name
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, format_labels(labels), value))
+
+        def grouped(metrics):
+            names = {}
+            for (name, labels), value in sorted(metrics.iteritems()):
+                names.setdefault(name, []).append((labels, value))
+            return sorted(names.iteritems())
+
+        with self.lock:
+            counters = dict(self.counters)
+            timers = dict(self.timers)
+            gauges = dict(self.gauges)
+
+        for name, samples in grouped(counters):
+            add('counter', name, [('', labels, value) for labels, value in samples])
+
+        for name, samples in grouped(timers):
+            rendered = []
+            for labels, (count, total, worst) in samples:
+                rendered.append(('_count', labels, count))
+                rendered.append(('_sum', labels, total))
+                rendered.append(('_max', labels, worst))
+            add('summary', name, rendered)
+
+        for name, samples in grouped(gauges):
+            add('gauge', name, [('', labels, value) for labels, value in samples])
+
+        for name, (function, label) in sorted(self.callbacks.iteritems()):
+            values = function()
+            add('gauge', name, [('', ((label, key),), value)
+                for key, value in sorted(values.iteritems())
+                if isinstance(value, (int, long, float))])
+
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler(object):
+    """
+    Optional per-request profiling, switched on and off at runtime.  Keeps
+    the cProfile output of the last `keep` requests.
+    """
+
+    def __init__(self, keep, limit=30):
+        self.enabled = False
+        self.limit = limit
+        self.profiles = collections.deque(maxlen=keep)
+
+    def run(self, name, function, *args, **kwargs):
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            output = StringIO.StringIO()
+            stats = pstats.Stats(profile, stream=output)
+            stats.sort_stats('cumulative').print_stats(self.limit)
+            self.profiles.append({
+                'endpoint': name,
+                'time': start,
+                'seconds': time.time() - start,
+                'stats': output.getvalue()
+            })
+
+
+metrics = Metrics('shitstream_')
+profiler = Profiler(20)
@@ -1,38 +1,306 @@
+from contextlib import contextmanager
 import socket
+import threading
 import time
-from mpd import MPDClient
+from mpd import MPDClient, CommandError, ConnectionError
+from metrics import metrics
 import settings
 
+
+class InstrumentedMPDClient(MPDClient):
+    """Times every command except idle, which blocks by design"""
+
+    def _execute(self, command, args, retval):
+        if command in ('idle', 'noidle'):
+            return MPDClient._execute(self, command, args, retval)
+        with metrics.timer('mpd_command_seconds', command=command):
+            return MPDClient._execute(self, command, args, retval)
+
+
 def mpd(func):
     def fn_wrap(*args, **kwargs):
-        if not kwargs.get('mpdc'):
-            kwargs['mpdc'] = mpd_connect()
-        return func(*args, **kwargs)
+        if kwargs.get('mpdc'):
+            return func(*args, **kwargs)
+        with mpd_pool.connection() as mpdc:
+            kwargs['mpdc'] = mpdc
+            return func(*args, **kwargs)
     fn_wrap.func_name = func.func_name
     return fn_wrap
 
 
+def set_nodelay(mpdc):
+    """
+    python-mpd2 writes each command of a command list separately and reads
+    nothing until the end, so with Nagle on every list after the first
+    command waits out MPD's delayed ACK
+    """
+    sock = mpdc._sock
+    if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
 def mpd_connect(mpdc=None):
+    """
+    Open a connection to MPD, retrying with exponential backoff if MPD is
+    flooded.  Use this directly only for dedicated connections such as the
+    idle loops, everything else should go through mpd_pool.
+    """
     if not mpdc:
-        mpdc = MPDClient(use_unicode=True)
+        mpdc = InstrumentedMPDClient(use_unicode=True)
     else:
         try:
             mpdc.disconnect()
         except:
-            mpdc = MPDClient(use_unicode=True)
+            mpdc = InstrumentedMPDClient(use_unicode=True)
 
-    # Try connecting a few times, sometimes MPD can get flooded
-    attempts = 0
-    connected = False
-    while connected == False and attempts < 4:
+    delay = settings.mpd_connect_backoff
+    for attempt in range(settings.mpd_connect_attempts):
         try:
-            mpdc.connect(settings.mpd_server, settings.mpd_port)
-            connected = True
+            with metrics.timer('mpd_connect_seconds'):
+                mpdc.connect(settings.mpd_server, settings.mpd_port)
+            set_nodelay(mpdc)
+            return mpdc
         except socket.error:
-            connected = False
-        attempts += 1
-        time.sleep(0.5)
+            metrics.inc('mpd_connect_failures_total')
+            if attempt == settings.mpd_connect_attempts - 1:
+                raise
+        time.sleep(delay)
+        delay *= 2
+
 
+def mpd_idle(mpdc, *subsystems):
+    """
+    Wait for a change in one of `subsystems` on a dedicated connection.
+    Reconnects if MPD dropped the connection, so callers should resync
+    after this returns either way.  Returns the client to keep using.
+    """
+    try:
+        mpdc.idle(*subsystems)
+    except (ConnectionError, socket.error):
+        mpd_pool.reconnects += 1
+        mpdc = mpd_connect(mpdc)
     return mpdc
 
 
+class MPDPoolTimeout(Exception):
+    pass
+
+
+class MPDPool(object):
+    """
+    A bounded, thread-safe pool of MPD connections.  Connections that have
+    sat idle for longer than `check_after` seconds are pinged before being
+    handed out and reconnected if MPD has dropped them.
+    """
+
+    def __init__(self, size, timeout, check_after):
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.cond = threading.Condition()
+        self.idle = []
+        self.created = 0
+
+        self.acquired = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.reconnects = 0
+
+    def acquire(self):
+        start = time.time()
+        with self.cond:
+            while not self.idle and self.created >= self.size:
+                remaining = self.timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise MPDPoolTimeout('No MPD connection available')
+                self.cond.wait(remaining)
+
+            if self.idle:
+                mpdc, last_used = self.idle.pop()
+            else:
+                mpdc, last_used = None, None
+                self.created += 1
+
+            waited = time.time() - start
+            metrics.observe('mpd_pool_wait_seconds', waited)
+            self.acquired += 1
+            if waited > 0.001:
+                self.waits += 1
+                self.wait_time += waited
+
+        try:
+            if mpdc is None:
+                mpdc = mpd_connect()
+            elif time.time() - last_used > self.check_after:
+                try:
+                    mpdc.ping()
+                except (ConnectionError, socket.error):
+                    self.reconnects += 1
+                    mpdc = mpd_connect(mpdc)
+        except:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+        return mpdc
+
+    def release(self, mpdc, broken=False):
+        with self.cond:
+            if broken:
+                self.created -= 1
+                try:
+                    mpdc.disconnect()
+                except:
+                    pass
+            else:
+                self.idle.append((mpdc, time.time()))
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        mpdc = self.acquire()
+        try:
+            yield mpdc
+        except CommandError:
+            # MPD rejected a command, the connection itself is fine
+            self.release(mpdc)
+            raise
+        except:
+            self.release(mpdc, broken=True)
+            raise
+        else:
+            self.release(mpdc)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.size,
+                'open': self.created,
+                'idle': len(self.idle),
+                'in_use': self.created - len(self.idle),
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'reconnects': self.reconnects
+            }
+
+
+mpd_pool = MPDPool(
+    settings.mpd_pool_size,
+    settings.mpd_pool_timeout,
+    settings.mpd_pool_check_after
+)
+metrics.gauge('mpd_pool', mpd_pool.stats)
+
+
+class UpdateBatch(object):
+    def __init__(self):
+        self.uris = set()
+        self.job = None
+        self.error = None
+
+
+class UpdateCoordinator(object):
+    """
+    Shares a single watcher of MPD's database updates between everyone
+    waiting for one.  Requests that arrive within `coalesce` seconds of each
+    other are sent to MPD as one batch, and the watcher wakes every waiter
+    whose update job has finished.
+    """
+
+    def __init__(self, coalesce, tick=1.0):
+        self.coalesce = coalesce
+        self.tick = tick
+        self.cond = threading.Condition()
+        self.batch = None
+        self.issued = 0
+        self.completed = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.watch, name='mpd-update')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def watch(self):
+        mpdc = mpd_connect()
+        while True:
+            self.check(mpdc)
+            mpdc = mpd_idle(mpdc, 'update')
+
+    def check(self, mpdc):
+        updating = mpdc.status().get('updating_db')
+        with self.cond:
+            # MPD runs update jobs in order, so everything before the one
+            # currently running has finished
+            if updating:
+                completed = int(updating) - 1
+            else:
+                completed = self.issued
+            self.completed = max(self.completed, completed)
+            self.cond.notify_all()
+
+    def issue(self, uris):
+        with mpd_pool.connection() as mpdc:
+            if None in uris:
+                return int(mpdc.update())
+            mpdc.command_list_ok_begin()
+            for uri in uris:
+                mpdc.update(uri)
+            return max(int(job) for job in mpdc.command_list_end())
+
+    def request(self, uri=None):
+        """Ask MPD to rescan `uri` (everything if None), returns the job"""
+        with self.cond:
+            leader = self.batch is None
+            if leader:
+                self.batch = UpdateBatch()
+            batch = self.batch
+            batch.uris.add(uri or None)
+
+        if leader:
+            time.sleep(self.coalesce)
+            with self.cond:
+                self.batch = None
+            try:
+                job = self.issue(batch.uris)
+            except Exception as exception:
+                job = None
+                batch.error = exception
+            with self.cond:
+                batch.job = job
+                if job:
+                    self.issued = max(self.issued, job)
+                self.cond.notify_all()
+            # The update may have finished before the watcher knew about it
+            if job:
+                with mpd_pool.connection() as mpdc:
+                    self.check(mpdc)
+
+        with self.cond:
+            while batch.job is None and batch.error is None:
+                self.cond.wait(self.tick)
+        if batch.error:
+            raise batch.error
+        return batch.job
+
+    def wait(self, uri=None, updating=None):
+        """Rescan `uri` and block until MPD has finished doing so"""
+        job = self.request(uri)
+        while True:
+            with self.cond:
+                if self.completed >= job:
+                    return
+                self.cond.wait(self.tick)
+                if self.completed >= job:
+                    return
+            if updating:
+                updating()
+            # Without a watcher nobody will wake us, check ourselves
+            if not (self.thread and self.thread.is_alive()):
+                with mpd_pool.connection() as mpdc:
+                    self.check(mpdc)
+
+
+update_coordinator = UpdateCoordinator(settings.mpd_update_coalesce)
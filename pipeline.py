@@ -0,0 +1,251 @@
+from contextlib import contextmanager
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import threading
+import time
+
+from concurrency import offload
+import db
+from metrics import metrics
+from mpd_util import update_coordinator
+import settings
+
+
+class Stage(object):
+    """
+    One step of the download pipeline.  At most `limit` downloads are in
+    the step at once, the rest wait for a slot.  A download leaves its
+    slot before waiting for one in the next step, so a full stage doesn't
+    hold up the one before it.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(limit)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+
+    @contextmanager
+    def slot(self):
+        with self.lock:
+            self.waiting += 1
+        with metrics.timer('pipeline_wait_seconds', stage=self.name):
+            self.slots.acquire()
+        with self.lock:
+            self.waiting -= 1
+            self.active += 1
+        try:
+            with metrics.timer('pipeline_stage_seconds', stage=self.name):
+                yield
+        finally:
+            with self.lock:
+                self.active -= 1
+            self.slots.release()
+
+
+def mpd_uri(filename):
+    """Path of a file in the download directory relative to MPD's root"""
+    common = os.path.commonprefix([settings.download_dir, settings.mpd_dir])
+    uri = filename.replace(common, '')
+    if uri[0] == '/':
+        uri = uri[1:]
+    return uri
+
+
+def content_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def transcode(source, output):
+    subprocess.check_call([settings.ffmpeg, '-y', '-loglevel', 'error',
+        '-i', source, '-vn', '-map_metadata', '0',
+        '-codec:a', 'libmp3lame', '-q:a', '2', output])
+
+
+def probe(filename):
+    """Returns the file's tags, lowercased, and its duration in seconds"""
+    output = subprocess.check_output([settings.ffprobe, '-v', 'quiet',
+        '-print_format', 'json', '-show_format', filename])
+    info = json.loads(output).get('format', {})
+    tags = dict((key.lower(), val) for key, val in info.get('tags', {}).iteritems())
+    return tags, float(info.get('duration') or 0)
+
+
+loudness_regex = re.compile(r'I:\s+(?P<lufs>-?[0-9.]+) LUFS')
+
+def loudness(filename):
+    """Integrated EBU R128 loudness in LUFS, None if it can't be measured"""
+    process = subprocess.Popen([settings.ffmpeg, '-nostats', '-i', filename,
+        '-af', 'ebur128', '-f', 'null', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = process.communicate()[1]
+    # The summary comes last
+    matches = loudness_regex.findall(output)
+    if process.returncode or not matches:
+        return None
+    return float(matches[-1])
+
+
+def song_from_tags(filename, tags, duration):
+    """Song data in the same shape as MPD's listallinfo"""
+    title = os.path.splitext(os.path.basename(filename))[0]
+    track = (tags.get('track') or '').split('/')[0]
+    return {
+        'file': mpd_uri(filename),
+        'title': tags.get('title') or title,
+        'artist': tags.get('artist'),
+        'albumartist': tags.get('album_artist'),
+        'album': tags.get('album'),
+        'date': tags.get('date'),
+        'track': track or None,
+        'time': int(duration),
+        # Same format MPD uses, so the next sync sees the song as unchanged
+        'last-modified': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+            time.gmtime(os.path.getmtime(filename)))
+    }
+
+
+class Pipeline(object):
+    """
+    Turns a URL into a song in the database in four stages, each with its
+    own concurrency limit: fetch the source audio, transcode it to mp3
+    (one ffmpeg process per core by default), read its tags and loudness,
+    then insert it into the database from those tags once MPD has scanned
+    the file.  Any earlier and a library sync would remove it again as
+    missing from MPD.
+    """
+
+    def __init__(self):
+        cores = multiprocessing.cpu_count()
+        self.stages = dict((name, Stage(name, limit)) for name, limit in [
+            ('fetch', settings.pipeline_fetch_limit or cores),
+            ('transcode', settings.pipeline_transcode_limit or cores),
+            ('analyze', settings.pipeline_analyze_limit or cores),
+            # SQLite only has one writer anyway
+            ('insert', 1)
+        ])
+        for stat in ('active', 'waiting'):
+            metrics.gauge('pipeline_' + stat, lambda stat=stat: dict(
+                (name, getattr(stage, stat)) for name, stage in self.stages.iteritems()),
+                label='stage')
+
+    def find(self, criterion):
+        """The dedup entry matching `criterion` and its song's id, or None"""
+        return db.db.session.query(db.DownloadSource, db.Song.id).\
+            join(db.Song, db.Song.uri == db.DownloadSource.uri).\
+            filter(criterion).first()
+
+    def hit(self, entry_id, match):
+        entry = db.DownloadSource.query.get(entry_id)
+        entry.hits += 1
+        metrics.inc('dedup_hits_total', match=match)
+        metrics.inc('dedup_bytes_saved_total', entry.size)
+        return entry
+
+    def remember(self, key, digest, uri, size):
+        entry = None
+        if key:
+            entry = db.DownloadSource.query.filter_by(source=key).first()
+        if not entry:
+            entry = db.DownloadSource(source=key)
+            db.db.session.add(entry)
+        entry.content_hash = digest
+        entry.uri = uri
+        entry.size = size
+        return entry
+
+    def lookup(self, downloader, url):
+        """The (song id, uri) `url` was already downloaded as, or None"""
+        key = downloader.source_id(url)
+        found = key and self.find(db.DownloadSource.source == key)
+        if not found:
+            return None
+        entry, song_id = found
+        db.writer.run(self.hit, entry.id, 'source')
+        return song_id, entry.uri
+
+    def run(self, downloader, url, emit):
+        """Returns the song's id and its MPD uri"""
+        key = downloader.source_id(url)
+        staging = os.path.join(settings.download_dir, '.fetch')
+        if not os.path.isdir(staging):
+            os.makedirs(staging)
+
+        with self.stages['fetch'].slot():
+            with metrics.timer('download_seconds', downloader=downloader):
+                source = downloader.fetch(url, staging, emit)
+            metrics.inc('download_bytes_total', os.path.getsize(source), downloader=downloader)
+            digest = offload(content_hash, source)
+
+        # Same file from another URL
+        found = self.find(db.DownloadSource.content_hash == digest)
+        if found:
+            entry, song_id = found
+            emit('response', {'msg': 'Song already downloaded from another URL'})
+            os.remove(source)
+            with self.stages['insert'].slot():
+                db.writer.run(self.reuse, entry.id, key, digest)
+            return song_id, entry.uri
+
+        name = os.path.splitext(os.path.basename(source))[0]
+        output = os.path.join(settings.download_dir, name + '.mp3')
+        with self.stages['transcode'].slot():
+            if source.endswith('.mp3'):
+                os.rename(source, output)
+            elif os.path.exists(output):
+                emit('response', {'msg': 'Song already converted, skipping conversion'})
+                os.remove(source)
+            else:
+                emit('response', {'msg': 'Converting song'})
+                with metrics.timer('transcode_seconds', downloader=downloader):
+                    transcode(source, output)
+                os.remove(source)
+
+        with self.stages['analyze'].slot():
+            emit('response', {'msg': 'Reading tags'})
+            tags, duration = probe(output)
+            lufs = loudness(output)
+
+        song = song_from_tags(output, tags, duration)
+        size = os.path.getsize(output)
+        # If a sync gets the song from MPD first, the insert fills in the rest
+        update_coordinator.wait(song['file'],
+            lambda: emit('response', {'msg': 'Music database still updating'}))
+        with self.stages['insert'].slot():
+            song_id = db.writer.run(self.insert, song, lufs, key, digest, size)
+        return song_id, song['file']
+
+    def reuse(self, entry_id, key, digest):
+        entry = self.hit(entry_id, 'content')
+        # Without a source id there's nothing new to remember, the hash
+        # is already known
+        if key:
+            self.remember(key, digest, entry.uri, entry.size)
+
+    def insert(self, song, lufs, key, digest, size):
+        new_song = db.new_song_from_mpd_data(song)
+        new_song.loudness = lufs
+        self.remember(key, digest, song['file'], size)
+        db.flush_songs()
+        db.library_changed()
+        return db.song_ids.get(song['file'])
+
+    def dedup_stats(self):
+        entries, hits, saved = db.db.session.query(
+            db.db.func.count(db.DownloadSource.id),
+            db.db.func.sum(db.DownloadSource.hits),
+            db.db.func.sum(db.DownloadSource.hits * db.DownloadSource.size)).one()
+        return {'entries': entries, 'hits': hits or 0, 'bytes_saved': saved or 0}
+
+
+pipeline = Pipeline()
@@ -0,0 +1,154 @@
+import re
+
+import sqlalchemy
+from sqlalchemy.exc import OperationalError
+
+import db
+
+
+class SearchIndex(object):
+    """
+    Full-text index over song, artist and album names in an SQLite FTS5
+    table keyed by song id.  The index is maintained by triggers on the
+    song, artist and album tables, so every write that goes through
+    new_song_from_mpd_data (or a bulk delete) updates it in the same
+    transaction.  Falls back to LIKE queries on databases without FTS5.
+
+    Only the first `candidates` matches are ranked.  bm25() reads every
+    match of every word to weigh them, which took most of a second for
+    words found in the whole of a 200k song library.
+    """
+
+    table = 'library_search'
+
+    # Relative weight of each indexed column when ranking
+    weights = (4.0, 3.0, 1.0, 2.0)
+    columns = ('song', 'artist', 'artist_alpha', 'album')
+
+    candidates = 500
+
+    select_songs = '''
+        SELECT song.id, song.name, artist.name, artist.name_alpha, album.name
+        FROM song
+        LEFT JOIN artist ON artist.id = song.artist_id
+        LEFT JOIN album ON album.id = song.album_id
+    '''
+
+    def __init__(self):
+        self.enabled = False
+
+    def index_sql(self, where):
+        return 'INSERT INTO {} (rowid, song, artist, artist_alpha, album) {} WHERE {};'.format(
+            self.table, self.select_songs, where)
+
+    def unindex_sql(self, where):
+        return 'DELETE FROM {} WHERE rowid IN (SELECT id FROM song WHERE {});'.format(
+            self.table, where)
+
+    def create(self):
+        engine = db.db.engine
+        if engine.dialect.name != 'sqlite':
+            return
+        try:
+            engine.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5(
+                    song, artist, artist_alpha, album,
+                    tokenize='unicode61 remove_diacritics 1', prefix='2 3')
+            '''.format(self.table))
+        except OperationalError:
+            print 'SQLite has no FTS5, searching without an index'
+            return
+
+        triggers = {
+            'song_insert': ('AFTER INSERT ON song',
+                self.index_sql('song.id = new.id')),
+            'song_update': ('AFTER UPDATE ON song',
+                'DELETE FROM {} WHERE rowid = old.id; '.format(self.table) +
+                self.index_sql('song.id = new.id')),
+            'song_delete': ('AFTER DELETE ON song',
+                'DELETE FROM {} WHERE rowid = old.id;'.format(self.table)),
+            'artist_update': ('AFTER UPDATE OF name, name_alpha ON artist',
+                self.unindex_sql('song.artist_id = new.id') +
+                self.index_sql('song.artist_id = new.id')),
+            'album_update': ('AFTER UPDATE OF name ON album',
+                self.unindex_sql('song.album_id = new.id') +
+                self.index_sql('song.album_id = new.id')),
+        }
+        for name, (when, body) in triggers.iteritems():
+            engine.execute('CREATE TRIGGER IF NOT EXISTS {}_{} {} BEGIN {} END'.format(
+                self.table, name, when, body))
+
+        self.enabled = True
+
+        # Songs written before the index existed
+        indexed = engine.execute('SELECT count(*) FROM {}'.format(self.table)).scalar()
+        if indexed != db.Song.query.count():
+            self.rebuild()
+
+    def rebuild(self):
+        with db.db.engine.begin() as connection:
+            connection.execute('DELETE FROM {}'.format(self.table))
+            connection.execute(self.index_sql('1'))
+
+    def words(self, text):
+        return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+    def match_query(self, words):
+        """
+        Quote each word, and match the last one as a prefix unless it's a
+        single character, which would be a prefix of most of the library
+        """
+        if not words:
+            return None
+        terms = [u'"{}"'.format(word) for word in words]
+        if len(words[-1]) > 1:
+            terms[-1] += u'*'
+        return u' '.join(terms)
+
+    def score_sql(self, words):
+        """
+        Weighted count of the columns each word appears in, shorter song
+        names first when that ties.  SQLite's lower() only knows ASCII, so
+        accented names can rank lower but still match.
+        """
+        terms = []
+        for i in range(len(words)):
+            for column, weight in zip(self.columns, self.weights):
+                terms.append('{} * (instr(lower({}), :word{}) > 0)'.format(weight, column, i))
+        return '{} DESC, length(song), rowid'.format(' + '.join(terms))
+
+    def search(self, text, limit):
+        """Returns the ids of songs matching `text`, best match first"""
+        if not self.enabled:
+            return self.search_like(text, limit)
+
+        words = self.words(text)
+        match = self.match_query(words)
+        if not match:
+            return []
+        params = dict(('word{}'.format(i), word) for i, word in enumerate(words))
+        params.update(match=match, limit=limit, candidates=max(limit, self.candidates))
+        rows = db.db.session.execute(sqlalchemy.text('''
+            SELECT rowid FROM (
+                SELECT rowid, {columns} FROM {table} WHERE {table} MATCH :match
+                LIMIT :candidates
+            ) ORDER BY {score} LIMIT :limit
+        '''.format(table=self.table, columns=', '.join(self.columns),
+            score=self.score_sql(words))), params)
+        return [row[0] for row in rows]
+
+    def search_like(self, text, limit):
+        pattern = u'%{}%'.format(text.strip())
+        query = db.db.session.query(db.Song.id).\
+            outerjoin(db.Artist, db.Song.artist_id == db.Artist.id).\
+            outerjoin(db.Album, db.Song.album_id == db.Album.id).\
+            filter(db.db.or_(
+                db.Song.name.like(pattern),
+                db.Artist.name.like(pattern),
+                db.Artist.name_alpha.like(pattern),
+                db.Album.name.like(pattern)
+            )).limit(limit)
+        return [row[0] for row in query]
+
+
+search_index = SearchIndex()
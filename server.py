@@ -1,22 +1,27 @@
 #!flask/bin/python
 
+# Must come first, it may monkey patch the standard library
+import concurrency
+
 from functools import wraps
 import glob
+import json
 import os
 import threading
 import time
 
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_file, stream_with_context
 from flask.ext.conditional import conditional
-from flask.ext.socketio import SocketIO, emit
-from flask.ext import restless
-from lxml import html
-import requests
+from flask.ext.socketio import SocketIO, emit, join_room
 
 from downloaders.youtube import youtube_downloader
 from downloaders.soundcloud import soundcloud_downloader
-from emberify import emberify
-from mpd_util import mpd, mpd_connect
+from downloaders import playlist
+from cache import cached, response_cache
+from cluster import cluster
+from icecast import IcecastStats
+from emberify import register as register_serializer, serializers
+from mpd_util import mpd, mpd_pool, update_coordinator
 import settings
 
 
@@ -32,6 +37,12 @@ def create_app():
 
 app = create_app()
 import db
+from autodj import autodj
+from events import event_log
+import jobs
+from metrics import metrics, profiler
+from pipeline import pipeline
+from search import search_index
 
 api_prefix = '/api/v1.0'
 socketio = SocketIO(app)
@@ -41,7 +52,23 @@ def api_route(route, *args, **kwargs):
         @app.route(api_prefix + route, *args, **kwargs)
         @wraps(function)
         def route_fn(*args, **kwargs):
-            return function(*args, **kwargs)
+            name = function.__name__
+            start = time.time()
+            try:
+                if profiler.enabled:
+                    response = profiler.run(name, function, *args, **kwargs)
+                else:
+                    response = function(*args, **kwargs)
+            except:
+                metrics.inc('http_requests_total', endpoint=name, status=500)
+                raise
+            finally:
+                metrics.observe('http_request_seconds', time.time() - start,
+                    endpoint=name, method=request.method)
+            # Views also return (response, status) tuples
+            response = app.make_response(response)
+            metrics.inc('http_requests_total', endpoint=name, status=response.status_code)
+            return response
         return route_fn
     return wrapper
 
@@ -59,46 +86,408 @@ def del_song_from_queue(queue_id, mpdc=None):
     return jsonify({})
 
 
+def enqueue_songs(mpdc, songs):
+    """
+    Add (song id, uri) pairs to the end of MPD's queue with one pipelined
+    command list, and start playing if nothing is.  Returns the new queue
+    entries.
+    """
+    mpdc.command_list_ok_begin()
+    for song_id, uri in songs:
+        mpdc.addid(uri)
+    mpdc.status()
+    mpdc.currentsong()
+    results = mpdc.command_list_end()
+
+    queue_ids = [int(queue_id) for queue_id in results[:-2]]
+    status, current = results[-2:]
+    if not current and queue_ids:
+        mpdc.playid(queue_ids[0])
+
+    # The command list ran as a unit, so the new entries are the last ones
+    first_pos = int(status['playlistlength']) - len(queue_ids)
+    return [{
+        'id': queue_id,
+        'pos': first_pos + i,
+        'song': song_id
+    } for i, (queue_id, (song_id, uri)) in enumerate(zip(queue_ids, songs))]
+
+
 @api_route('/queue', methods=['POST'])
 @mpd
 def add_song_to_queue(mpdc=None):
     song_id = request.json['queue']['song']
     song = db.Song.query.filter(db.Song.id == song_id).one()
-    queue_id = int(mpdc.addid(song.uri))
-    queue_data = mpdc.playlistid(queue_id)[0]
-    if not mpdc.currentsong():
-        mpdc.playid(queue_id)
+    queue = enqueue_songs(mpdc, [(song.id, song.uri)])[0]
+    return jsonify({'queue': queue})
 
-    return jsonify({'queue': {
-        'id': queue_id,
-        'pos': queue_data['pos'],
-        'song': song_id
-    }})
+
+@api_route('/queue/bulk', methods=['POST'])
+@mpd
+def add_songs_to_queue(mpdc=None):
+    """
+    Queue a list of songs ({"songs": [ids]}), a whole album ({"album": id})
+    or an artist's songs that aren't on an album ({"artist": id}).
+    """
+    data = request.json or {}
+    query = db.db.session.query(db.Song.id, db.Song.uri)
+    if data.get('album'):
+        songs = query.filter(db.Song.album_id == data['album']).\
+            order_by(db.Song.track, db.Song.id).all()
+    elif data.get('artist'):
+        songs = query.filter(db.Song.artist_id == data['artist'],
+            db.Song.album_id == None).order_by(db.Song.name, db.Song.id).all()
+    elif data.get('songs'):
+        found = {}
+        for chunk in db.chunked(data['songs'], 500):
+            found.update((row.id, row) for row in query.filter(db.Song.id.in_(chunk)))
+        songs = [found[song_id] for song_id in data['songs'] if song_id in found]
+    else:
+        return jsonify({'error': 'No songs, album or artist given'}), 400
+
+    if not songs:
+        return jsonify({'error': 'No songs found'}), 404
+    return jsonify({'queue': enqueue_songs(mpdc, songs)})
+
+
+@api_route('/queue/move', methods=['POST'])
+@mpd
+def move_queue(mpdc=None):
+    """
+    Move queue entries, {"moves": [{"queue": id, "pos": new position}]}.
+    The moves are sent as one command list so no other client's changes
+    land in between.
+    """
+    moves = (request.json or {}).get('moves')
+    if not moves:
+        return jsonify({'error': 'No moves given'}), 400
+    mpdc.command_list_ok_begin()
+    for move in moves:
+        mpdc.moveid(int(move['queue']), int(move['pos']))
+    mpdc.command_list_end()
+    return jsonify({})
+
+
+@api_route('/queue/reorder', methods=['POST'])
+@mpd
+def reorder_queue(mpdc=None):
+    """
+    Put queue entries in the given order starting at `pos` (default 0),
+    {"order": [ids], "pos": 0}.  Entries must currently be at or after
+    `pos`.  Sent as one command list like move.
+    """
+    data = request.json or {}
+    order = data.get('order')
+    if not order:
+        return jsonify({'error': 'No order given'}), 400
+    start = int(data.get('pos', 0))
+    mpdc.command_list_ok_begin()
+    for i, queue_id in enumerate(order):
+        mpdc.moveid(int(queue_id), start + i)
+    mpdc.command_list_end()
+    return jsonify({})
+
+
+def prefix_filter(column):
+    def apply(query, value):
+        value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return query.filter(column.like(value + '%', escape='\\'))
+    return apply
+
+
+def equal_filter(column):
+    def apply(query, value):
+        return query.filter(column == value)
+    return apply
+
+
+def artist_prefix_filter(model):
+    def apply(query, value):
+        return prefix_filter(db.Artist.name)(
+            query.join(db.Artist, model.artist_id == db.Artist.id), value)
+    return apply
+
+
+def stream_collection(serializer, query):
+    """Yield the whole collection as JSON, a page of records at a time"""
+    session = db.db.session
+    yield '{{"{}": ['.format(serializer.plural)
+    first = True
+    after = None
+    while True:
+        page = query
+        if after is not None:
+            page = page.filter(serializer.model.id > after)
+        rows = page.limit(settings.api_page_size).all()
+        if not rows:
+            break
+        for record in serializer.records(session, rows):
+            if not first:
+                yield ','
+            first = False
+            yield json.dumps(record)
+        after = rows[-1].id
+    yield ']}'
+
+
+def collection(model, filters):
+    """
+    Ember-shaped collection response with keyset pagination.  Pages are
+    ordered by id, `after` is the last id of the previous page, and the
+    next cursor is returned in `meta`.  Ember's `ids[]` lookups return the
+    requested records unpaginated, and `stream=1` streams everything.
+    """
+    serializer = serializers[model]
+    session = db.db.session
+    query = serializer.query(session).order_by(model.id)
+
+    for name, apply in filters.iteritems():
+        value = request.args.get(name)
+        if value:
+            query = apply(query, value)
+
+    sideload = request.args.getlist('include')
+    ids = request.args.getlist('ids[]', type=int)
+    if ids:
+        query = query.filter(model.id.in_(ids))
+        return jsonify(serializer.serialize(session, query.all(), sideload=sideload))
+
+    if request.args.get('stream'):
+        return Response(stream_with_context(stream_collection(serializer, query)),
+            mimetype='application/json')
+
+    limit = request.args.get('limit', settings.api_page_size, type=int)
+    limit = max(1, min(limit, settings.api_max_page_size))
+    after = request.args.get('after', type=int)
+    if after:
+        query = query.filter(model.id > after)
+
+    rows = query.limit(limit + 1).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    result = serializer.serialize(session, rows, sideload=sideload)
+    result['meta'] = {
+        'limit': limit,
+        'next': rows[-1].id if more else None
+    }
+    return jsonify(result)
+
+
+def record(model, record_id):
+    serializer = serializers[model]
+    session = db.db.session
+    rows = serializer.query(session).filter(model.id == record_id).all()
+    if not rows:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(serializer.serialize(session, rows, many=False,
+        sideload=request.args.getlist('include')))
+
+
+@api_route('/songs')
+@cached('library')
+def get_songs():
+    return collection(db.Song, {
+        'name': prefix_filter(db.Song.name),
+        'artist': artist_prefix_filter(db.Song),
+        'artist_id': equal_filter(db.Song.artist_id),
+        'album_id': equal_filter(db.Song.album_id)
+    })
+
+
+@api_route('/artists')
+@cached('library')
+def get_artists():
+    return collection(db.Artist, {
+        'name': prefix_filter(db.Artist.name)
+    })
+
+
+@api_route('/albums')
+@cached('library')
+def get_albums():
+    return collection(db.Album, {
+        'name': prefix_filter(db.Album.name),
+        'artist': artist_prefix_filter(db.Album),
+        'artist_id': equal_filter(db.Album.artist_id)
+    })
+
+
+@api_route('/queue')
+@cached('queue', 'library')
+def get_queue():
+    # The queue is bounded by MPD, so it comes in one piece, in order
+    serializer = serializers[db.Queue]
+    session = db.db.session
+    rows = serializer.query(session).order_by(db.Queue.pos).all()
+    return jsonify(serializer.serialize(session, rows,
+        sideload=request.args.getlist('include')))
+
+
+@api_route('/songs/<int:record_id>')
+@cached('library')
+def get_song(record_id):
+    return record(db.Song, record_id)
+
+
+@api_route('/artists/<int:record_id>')
+@cached('library')
+def get_artist(record_id):
+    return record(db.Artist, record_id)
+
+
+@api_route('/albums/<int:record_id>')
+@cached('library')
+def get_album(record_id):
+    return record(db.Album, record_id)
+
+
+@api_route('/queue/<int:record_id>')
+@cached('queue', 'library')
+def get_queue_entry(record_id):
+    return record(db.Queue, record_id)
+
+
+@api_route('/search')
+@cached('library')
+def search_songs():
+    text = request.args.get('q', '')
+    limit = request.args.get('limit', settings.search_limit, type=int)
+    limit = max(1, min(limit, settings.api_max_page_size))
+    ids = search_index.search(text, limit)
+
+    serializer = serializers[db.Song]
+    session = db.db.session
+    rows = []
+    for chunk in db.chunked(ids, 500):
+        rows.extend(serializer.query(session).filter(db.Song.id.in_(chunk)))
+    rank = dict((song_id, i) for i, song_id in enumerate(ids))
+    rows.sort(key=lambda row: rank[row.id])
+
+    result = serializer.serialize(session, rows, sideload=request.args.getlist('include'))
+    result['meta'] = {'query': text}
+    return jsonify(result)
+
+
+def send_event(event):
+    cluster.publish('events', event)
+
+event_log.send = send_event
+
+
+def receive_event(event, origin):
+    """Events from the sync owner, which may be us, for our own clients"""
+    if origin != cluster.node:
+        event_log.receive(event)
+    socketio.emit('event', event, namespace=api_prefix + '/events/')
+
+cluster.subscribe('events', receive_event)
+
+
+def receive_version(message, origin):
+    response_cache.update(message['scope'], message['version'])
+
+cluster.subscribe('versions', receive_version)
+
+
+@socketio.on('connect', namespace = api_prefix + '/events/')
+def events_connect():
+    emit('hello', {'seq': event_log.seq, 'epoch': event_log.epoch})
+
+
+@socketio.on('resume', namespace = api_prefix + '/events/')
+def events_resume(msg):
+    """Replay what a reconnecting client missed, if we still have it"""
+    try:
+        seq = int(msg.get('seq'))
+    except (AttributeError, TypeError, ValueError):
+        seq = None
+    missed = event_log.since(seq, msg.get('epoch')) if seq is not None else None
+    if missed is None:
+        emit('reset', {'seq': event_log.seq, 'epoch': event_log.epoch})
+        return
+    for event in missed:
+        emit('event', event)
 
 
 @socketio.on('connect', namespace = api_prefix + '/add_url/')
 def add_url_connect():
     emit('response', {'msg': 'Connected'});
 
-@mpd
-def update_mpd(uri=None, updating=None, mpdc=None):
-    job = mpdc.update(uri)
-    added = False
-    while not added:
-        cur_job = mpdc.status().get('updating_db')
-        if (cur_job and cur_job <= job):
-            if updating:
-                updating()
-            time.sleep(1)
-        else:
-            added = True
 
-@mpd
-@socketio.on('add_url', namespace = api_prefix + '/add_url/')
-def add_url_event(msg, mpdc=None):
-    in_dir = settings.download_dir
-    music_dir = settings.mpd_dir
+def match_downloader(url):
+    for downloader in app.downloaders:
+        if downloader.regex.match(url):
+            return downloader
+    return None
+
+
+def download_track(downloader, url, emit):
+    """Download one track, add it to MPD and queue it, returning its MPD uri"""
+    found = pipeline.lookup(downloader, url)
+    if found:
+        emit('response', {'msg': 'Song already downloaded, skipping download'})
+        song_id, uri = found
+    else:
+        # Add song to database
+        emit('response', {'msg': 'Adding song to music database'})
+        song_id, uri = pipeline.run(downloader, url, emit)
+    emit('response', {'msg': 'Song added to music database'})
+
+    # Add song to Queue
+    emit('response', {'msg': 'Adding song to queue'})
+    with mpd_pool.connection() as mpdc:
+        enqueue_songs(mpdc, [(song_id, uri)])
+    emit('response', {'msg': 'Song queued'})
 
+    return uri
+
+
+def download_url(url, emit):
+    """
+    Download a URL and queue it, returning its MPD uri.  Playlists,
+    channels and sets are downloaded a few tracks at a time, each queued
+    as soon as it is done, and return their uris one per line.
+    """
+    downloader = match_downloader(url)()
+    emit('response', {'msg': 'Starting {}'.format(downloader)})
+
+    urls = downloader.expand(url)
+    if len(urls) == 1:
+        return download_track(downloader, urls[0], emit)
+    if not urls:
+        raise Exception('No songs found')
+    emit('response', {'msg': 'Found {} songs'.format(len(urls))})
+
+    def handler(track, item_emit):
+        try:
+            return download_track(downloader, track, item_emit)
+        finally:
+            db.db.session.remove()
+
+    uris, errors = playlist.fetch_all(urls, handler, settings.playlist_parallelism,
+        emit, fatal=(jobs.JobCancelled,))
+    failed = len([error for error in errors if error])
+    # Retrying would queue the finished tracks again, so only fail outright
+    if failed == len(urls):
+        raise errors[0]
+    emit('response', {'msg': '{} of {} songs queued'.format(len(urls) - failed, len(urls))})
+    return '\n'.join(uri for uri in uris if uri)
+
+
+def job_room(job_id):
+    return 'job-{}'.format(job_id)
+
+
+def publish_job(job_id, event, data):
+    socketio.emit(event, data, namespace=api_prefix + '/add_url/',
+        room=job_room(job_id))
+
+download_jobs = jobs.JobQueue(settings.download_workers, download_url, publish_job)
+
+
+@socketio.on('add_url', namespace = api_prefix + '/add_url/')
+def add_url_event(msg):
     if not msg:
         emit('response', {'msg': 'No URL received'})
         return
@@ -110,65 +499,108 @@ def add_url_event(msg, mpdc=None):
 
     emit('response', {'msg': 'Received URL'})
 
-    # See if any REGEX match:
-    matched = False
-    matched_downloader = None
-    for downloader in app.downloaders:
-        if downloader.regex.match(url):
-            matched = True
-            matched_downloader = downloader()
-
     # Nobody matched, ya dun fucked up
-    if not matched:
+    if not match_downloader(url):
         emit('response', {'msg': 'URL does not appear to be valid'})
         return
 
     emit('response', {'msg': 'URL appears to be valid'})
-    emit('response', {'msg': 'Starting {}'.format(matched_downloader)})
 
-    try:
-        filename = matched_downloader.download(url, in_dir, emit)
-    except Exception as exception:
-        emit('response', {'msg': str(exception)})
-        emit('disconnect')
+    job_id = download_jobs.submit(url)
+    join_room(job_room(job_id))
+    emit('response', {'msg': 'Download queued', 'job': job_id})
+
+
+@socketio.on('subscribe', namespace = api_prefix + '/add_url/')
+def subscribe_job_event(msg):
+    status = download_jobs.status(msg.get('job'))
+    if not status:
+        emit('response', {'msg': 'No such job'})
         return
+    join_room(job_room(status['job']))
+    emit('response', dict(status, msg='Job {}'.format(status['status'])))
 
-    common = os.path.commonprefix([in_dir, music_dir])
-    uri = filename.replace(common, '')
-    mpdc = mpd_connect()
-    if uri[0] == '/':
-        uri = uri[1:]
 
-    # Add song to MPD
-    emit('response', {'msg': 'Adding song to music database'})
-    update_mpd(uri,
-        emit('response', {'msg': 'Music database still updating'}))
-    emit('response', {'msg': 'Song added to music database'})
+@socketio.on('cancel', namespace = api_prefix + '/add_url/')
+def cancel_job_event(msg):
+    job_id = msg.get('job')
+    if download_jobs.cancel(job_id):
+        emit('response', {'msg': 'Cancelling job', 'job': job_id})
+    else:
+        emit('response', {'msg': 'Job is not running', 'job': job_id})
 
-    # Add song to database
-    song = mpdc.listallinfo(uri)[0]
-    db.new_song_from_mpd_data(song)
-    db.db.session.commit()
 
-    # Add song to Queue
-    emit('response', {'msg': 'Adding song to queue'})
-    songid = mpdc.addid(uri)
-    if not mpdc.currentsong():
-        mpdc.playid(songid)
-    emit('response', {'msg': 'Song queued'})
+@socketio.on('retry', namespace = api_prefix + '/add_url/')
+def retry_job_event(msg):
+    job_id = msg.get('job')
+    if download_jobs.retry(job_id):
+        join_room(job_room(job_id))
+        emit('response', {'msg': 'Download queued', 'job': job_id})
+    else:
+        emit('response', {'msg': 'Job can not be retried', 'job': job_id})
+
+
+def push_listeners(stats):
+    # Every worker polls Icecast for its own clients, only the owner numbers events
+    socketio.emit('listeners', stats, namespace=api_prefix + '/listeners/')
+    if cluster.owner:
+        event_log.publish('listeners', stats)
+
+icecast_auth = None
+if settings.icecast_user:
+    icecast_auth = (settings.icecast_user, settings.icecast_password)
+
+icecast_stats = IcecastStats(
+    settings.icecast_status_url,
+    settings.icecast_poll_interval,
+    settings.icecast_ttl,
+    settings.icecast_timeout,
+    auth=icecast_auth,
+    on_change=push_listeners
+)
+
+
+def current_listeners():
+    stats = icecast_stats.current() or {}
+    return {
+        'listeners': stats.get('listeners'),
+        'mounts': stats.get('mounts', {})
+    }
 
-    emit('disconnect')
 
 @api_route('/listeners')
 def get_listeners():
-    try:
-        url = settings.icecast_status_url
-        page = requests.get(url)
-        tree = html.fromstring(page.text)
-        elem = tree.xpath('//td[text()="Current Listeners:"]/following-sibling::td')
-        return jsonify({'listeners':elem[0].text})
-    except:
-        return jsonify({'listeners': None})
+    return jsonify(current_listeners())
+
+
+# Flask-SocketIO only serves namespaces with a handler, without this one
+# browsers are refused and push_listeners reaches nobody
+@socketio.on('connect', namespace = api_prefix + '/listeners/')
+def listeners_connect():
+    emit('listeners', current_listeners())
+
+
+@api_route('/downloads/dedup')
+def get_dedup_stats():
+    return jsonify({'dedup': pipeline.dedup_stats()})
+
+
+@api_route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@api_route('/metrics/profile', methods=['GET', 'PUT'])
+def metrics_profile():
+    """Switch per-request profiling on or off, and fetch recent profiles"""
+    if request.method == 'PUT':
+        if not settings.metrics_profiling:
+            return jsonify({'error': 'Profiling is disabled'}), 403
+        profiler.enabled = bool((request.json or {}).get('enabled'))
+    return jsonify({
+        'enabled': profiler.enabled,
+        'profiles': list(profiler.profiles)
+    })
 
 
 ##
@@ -186,71 +618,70 @@ def tests_reset(mpdc=None):
     files = glob.glob(files_glob)
     for f in files:
         os.remove(f)
-    update_mpd(mpdc=mpdc)
+    db.DownloadSource.query.delete()
+    db.db.session.commit()
+    update_coordinator.wait()
     mpdc.clear()
     return jsonify({'status': 'OK'})
 
 
-def init():
-    db.db.create_all()
-    if settings.db_clear_on_load:
+def init_db():
+    db.migrate()
+    search_index.create()
+    # Other workers are serving the library, and song ids have to stay put
+    if settings.db_clear_on_load and cluster.role == 'all':
         db.clear_db_songs()
 
+
+def init_search():
+    """Workers that don't own the schema wait for it before searching"""
+    while not db.schema_current():
+        time.sleep(1)
+    search_index.create()
+
+
+def start_workers():
+    """What every worker runs, the owner or not"""
+    if cluster.role != 'all':
+        search_init = threading.Thread(target=init_search, name='search-init')
+        search_init.daemon = True
+        search_init.start()
+    update_coordinator.start()
+    icecast_stats.start()
+    # With several workers, a job another one is running looks just like
+    # one a crash left behind
+    download_jobs.start(resume=cluster.role == 'all')
+
+
+def start_sync():
+    """What only the sync owner runs, see cluster.py"""
+    init_db()
+
     queue_updates = threading.Thread(target=db.update_queue_on_change)
     queue_updates.start()
 
     song_updates = threading.Thread(target=db.update_songs_on_change)
     song_updates.start()
 
-    manager = restless.APIManager(app, flask_sqlalchemy_db=db.db)
-
-    #FIXME: copypaste
-    manager.create_api(
-        db.Artist,
-        methods=['GET'],
-        url_prefix=api_prefix,
-        collection_name='artists',
-        postprocessors={
-            'GET_MANY': [emberify('artists', db.Artist)],
-            'GET_SINGLE': [emberify('artist', db.Artist, many=False)]
-        },
-        results_per_page=None
-    )
-    manager.create_api(
-        db.Song,
-        methods=['GET'],
-        url_prefix=api_prefix,
-        collection_name='songs',
-        postprocessors={
-            'GET_MANY': [emberify('songs', db.Song)],
-            'GET_SINGLE': [emberify('song', db.Song, many=False)]
-        },
-        results_per_page=None
-    )
-    manager.create_api(
-        db.Album,
-        methods=['GET'],
-        url_prefix=api_prefix,
-        collection_name='albums',
-        postprocessors={
-            'GET_MANY': [emberify('albums', db.Album)],
-            'GET_SINGLE': [emberify('album', db.Album, many=False)]
-        },
-        results_per_page=None
-    )
-    manager.create_api(
-        db.Queue,
-        methods=['GET'],
-        url_prefix=api_prefix,
-        collection_name='queue',
-        postprocessors={
-            'GET_MANY': [emberify('queue', db.Queue)],
-            'GET_SINGLE': [emberify('queue', db.Queue, many=False)]
-        },
-        results_per_page=None
-    )
+    if settings.autodj_enabled:
+        autodj.start()
+
+
+def init_api():
+    artists = register_serializer(db.Artist, 'artist', 'artists')
+    artists.extra('non_album_songs', db.non_album_songs)
+    register_serializer(db.Song, 'song', 'songs')
+    register_serializer(db.Album, 'album', 'albums')
+    register_serializer(db.Queue, 'queue', 'queue')
+
+
+def init():
+    db.writer.start()
+    cluster.start(start_sync)
+    start_workers()
+    init_api()
 
 
 if __name__ == '__main__':
     init()
-    socketio.run(app)
+    socketio.run(app, host=settings.server_host, port=settings.server_port)
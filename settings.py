@@ -1,8 +1,9 @@
 import ConfigParser
+import os
 
 config = ConfigParser.ConfigParser()
 
-config.read('shitstream.conf')
+config.read(os.environ.get('SHITSTREAM_CONFIG', 'shitstream.conf'))
 
 def config_get(section, key, default, type_method=config.get):
     try:
@@ -13,12 +14,74 @@ def config_get(section, key, default, type_method=config.get):
 mpd_server = config_get('mpd', 'server', 'localhost')
 mpd_port = config_get('mpd', 'port', 6600)
 mpd_dir = config_get('mpd', 'music_dir', 'music')
+mpd_connect_attempts = config_get('mpd', 'connect_attempts', 4, config.getint)
+mpd_connect_backoff = config_get('mpd', 'connect_backoff', 0.1, config.getfloat)
+mpd_pool_size = config_get('mpd', 'pool_size', 8, config.getint)
+mpd_pool_timeout = config_get('mpd', 'pool_timeout', 10.0, config.getfloat)
+mpd_pool_check_after = config_get('mpd', 'pool_check_after', 30.0, config.getfloat)
+mpd_update_coalesce = config_get('mpd', 'update_coalesce', 0.05, config.getfloat)
 
-icecast_status_url = config_get('icecast', 'url', 'http://localhost:8000/status.xsl')
+icecast_status_url = config_get('icecast', 'url', 'http://localhost:8000/status-json.xsl')
+icecast_user = config_get('icecast', 'user', None)
+icecast_password = config_get('icecast', 'password', None)
+icecast_poll_interval = config_get('icecast', 'poll_interval', 5.0, config.getfloat)
+icecast_ttl = config_get('icecast', 'ttl', 30.0, config.getfloat)
+icecast_timeout = config_get('icecast', 'timeout', 2.0, config.getfloat)
 
 download_dir = config_get('downloaders', 'download_dir', 'music/in')
+download_workers = config_get('downloaders', 'workers', 2, config.getint)
+download_max_attempts = config_get('downloaders', 'max_attempts', 3, config.getint)
+playlist_parallelism = config_get('downloaders', 'playlist_parallelism', 4, config.getint)
+# A limit of 0 means one per CPU core
+pipeline_fetch_limit = config_get('downloaders', 'fetch_limit', 4, config.getint)
+pipeline_transcode_limit = config_get('downloaders', 'transcode_limit', 0, config.getint)
+pipeline_analyze_limit = config_get('downloaders', 'analyze_limit', 0, config.getint)
+progress_interval = config_get('downloaders', 'progress_interval', 0.5, config.getfloat)
+ffmpeg = config_get('downloaders', 'ffmpeg', 'ffmpeg')
+ffprobe = config_get('downloaders', 'ffprobe', 'ffprobe')
+
+soundcloud_client_id = config_get('soundcloud', 'client_id', None)
+soundcloud_timeout = config_get('soundcloud', 'timeout', 10.0, config.getfloat)
+soundcloud_chunk_size = config_get('soundcloud', 'chunk_size', 65536, config.getint)
 
 debug = config_get('general', 'debug', True, config.getboolean)
+# threads, or gevent to run everything cooperatively, see concurrency.py
+async_mode = config_get('general', 'async_mode', 'threads')
+server_host = config_get('general', 'host', '127.0.0.1')
+server_port = config_get('general', 'port', 5000, config.getint)
+metrics_profiling = config_get('general', 'profiling', debug, config.getboolean)
+
+api_page_size = config_get('api', 'page_size', 500, config.getint)
+api_max_page_size = config_get('api', 'max_page_size', 5000, config.getint)
+search_limit = config_get('api', 'search_limit', 50, config.getint)
+
+events_buffer = config_get('events', 'buffer', 1000, config.getint)
+events_max_delta = config_get('events', 'max_delta', 500, config.getint)
+
+cache_enabled = config_get('cache', 'enabled', True, config.getboolean)
+cache_max_bytes = config_get('cache', 'max_bytes', 64 * 1024 * 1024, config.getint)
+
+autodj_enabled = config_get('autodj', 'enabled', False, config.getboolean)
+autodj_lookahead = config_get('autodj', 'lookahead', 5, config.getint)
+autodj_song_window = config_get('autodj', 'song_window', 100, config.getint)
+autodj_artist_window = config_get('autodj', 'artist_window', 5, config.getint)
+autodj_album_window = config_get('autodj', 'album_window', 3, config.getint)
+# 0 picks every song equally, 1 every artist equally
+autodj_artist_balance = config_get('autodj', 'artist_balance', 0.5, config.getfloat)
+autodj_attempts = config_get('autodj', 'attempts', 20, config.getint)
 
 db_uri = config_get('db', 'uri', 'sqlite:///test.db')
+# Only in single process mode, a cluster keeps its library, see cluster.py
 db_clear_on_load = config_get('db', 'clear_on_load', True, config.getboolean)
+db_sync_batch_size = config_get('db', 'sync_batch_size', 500, config.getint)
+db_wal = config_get('db', 'wal', True, config.getboolean)
+db_busy_timeout = config_get('db', 'busy_timeout', 5000, config.getint)
+db_writer_batch = config_get('db', 'writer_batch', 50, config.getint)
+
+# all, auto or reader, see cluster.py
+cluster_role = config_get('cluster', 'role', 'all')
+# loopback only reaches this process, use redis for several workers
+cluster_bus = config_get('cluster', 'bus', 'loopback')
+cluster_redis_url = config_get('cluster', 'redis_url', 'redis://localhost:6379/0')
+cluster_prefix = config_get('cluster', 'prefix', 'shitstream:')
+cluster_lease_ttl = config_get('cluster', 'lease_ttl', 10.0, config.getfloat)
@@ -94,7 +94,19 @@ App.ArtistsView = Ember.View.extend({
 
 App.ArtistsRoute = Ember.Route.extend({
     model: function(params) {
-        return this.store.find('artist');
+        // Artists come back a page at a time, follow the cursor to the end
+        var store = this.store;
+        function page(after) {
+            return store.find('artist', {after: after}).then(function() {
+                var next = store.metadataFor('artist').next;
+                if (next) {
+                    return page(next);
+                }
+            });
+        }
+        return page(0).then(function() {
+            return store.all('artist');
+        });
     }
 });
 
@@ -106,16 +118,21 @@ App.ArtistRoute = Ember.Route.extend({
 
 App.ApplicationRoute = Ember.Route.extend({
     setupController: function(controller) {
-        Ember.$.getJSON('/api/v1.0/listeners').
-        then(function(data) {
+        function setListeners(data) {
             Ember.run(function() {
                 var listeners = '?';
-                if (data['listeners']) {
+                if (data['listeners'] != null) {
                     listeners = data['listeners']
                 }
                 controller.set('listeners', listeners);
             });
-        })
+        }
+
+        Ember.$.getJSON('/api/v1.0/listeners').then(setListeners);
+
+        // The server pushes new counts as they change
+        var socket = io.connect('/api/v1.0/listeners/');
+        socket.on('listeners', setListeners);
     }
 });
 
@@ -182,15 +199,17 @@ App.MusicRoute = Ember.Route.extend({
             });
         },
         queue_album: function(album) {
-            var self = this;
-            album.get('songs')
-            .then(function(songs) {
-                songs.forEach(function(song) {
-                    var queue = self.store.createRecord('queue', {})
-                    queue.set('song', song)
-                    queue.get('song').then(function() {queue.save()})
-                })
+            var store = this.store;
+            // Queue the whole album in one request
+            Ember.$.ajax({
+                url: '/api/v1.0/queue/bulk',
+                type: 'POST',
+                contentType: 'application/json',
+                data: JSON.stringify({album: album.get('id')})
             }).then(function(data) {
+                Ember.run(function() {
+                    store.pushMany('queue', data.queue);
+                });
                 $('#alert-placeholder').append(
                     '<div class="alert alert-success alert-dismissible" role="alert">' +
                         '<button type="button" class="close" data-dismiss="alert">' +
@@ -224,10 +243,68 @@ App.SongRoute = Ember.Route.extend({
     }
 });
 
+// Apply a change broadcast on the events namespace to the store
+App.applyEvent = function(store, event) {
+    var data = event.data;
+    if (event.type === 'queue') {
+        if (data.reload) {
+            store.find('queue');
+            return;
+        }
+        data.deleted.forEach(function(id) {
+            var queue = store.getById('queue', id);
+            if (queue) {
+                queue.unloadRecord();
+            }
+        });
+        data.inserted.concat(data.moved).forEach(function(queue) {
+            store.update('queue', queue);
+        });
+    } else if (event.type === 'player') {
+        store.all('queue').forEach(function(queue) {
+            store.update('queue', {
+                id: queue.get('id'),
+                played: data.pos !== null && queue.get('pos') < data.pos
+            });
+        });
+    }
+};
+
 App.QueueRoute = Ember.Route.extend({
     model: function(params) {
         return this.store.find('queue');
     },
+    activate: function() {
+        // Follow queue changes pushed by the server instead of refetching,
+        // resuming from the last event seen after a reconnect
+        if (this.socket) {
+            return;
+        }
+        var store = this.store;
+        var seq = null;
+        var epoch = null;
+        var socket = this.socket = io.connect('/api/v1.0/events/');
+        socket.on('hello', function(msg) {
+            if (seq === null) {
+                seq = msg.seq;
+                epoch = msg.epoch;
+            } else {
+                // The server tells us to reset if it restarted since
+                socket.emit('resume', {seq: seq, epoch: epoch});
+            }
+        });
+        socket.on('reset', function(msg) {
+            seq = msg.seq;
+            epoch = msg.epoch;
+            store.find('queue');
+        });
+        socket.on('event', function(event) {
+            seq = event.seq;
+            Ember.run(function() {
+                App.applyEvent(store, event);
+            });
+        });
+    },
     actions: {
         dequeue_song: function(queue) {
             queue.destroyRecord();
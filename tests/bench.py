@@ -0,0 +1,189 @@
+"""
+Benchmarks for the sync, serialization and queue hot paths, run against a
+fake MPD serving synthetic libraries.  Results are written as JSON so runs
+from different commits can be compared:
+
+    python tests/bench.py --tracks 1000,10000,100000 --queue 2000 -o bench.json
+
+Search is timed on the index alone, the response cache would otherwise
+answer every repeat.
+"""
+import argparse
+import json
+import os.path
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from fake_mpd import FakeMPD, generate_library
+import settings
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=parent).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Bench(object):
+
+    # From matching nearly everything down to a handful of songs
+    search_queries = ['s', 'so', 'song', 'artist', 'album 12', 'song 1234', 'artist 5 song']
+
+    def __init__(self, fake_mpd):
+        self.mpd = fake_mpd
+
+        import server
+        import db
+        from search import search_index
+        self.server = server
+        self.db = db
+        self.search_index = search_index
+
+        server.app.config['TESTING'] = True
+        server.init_db()
+        server.init_api()
+        self.client = server.app.test_client()
+
+    def reset(self, tracks, queue):
+        db = self.db
+        db.db.session.remove()
+        db.db.drop_all()
+        db.db.engine.execute('DROP TABLE IF EXISTS {}'.format(self.search_index.table))
+        db.db.create_all()
+        self.search_index.create()
+        db.reset_identity_caches()
+        db.queue_mirror.version = None
+
+        state = self.mpd.state
+        state.library = generate_library(tracks)
+        state.files = dict((song['file'], song) for song in state.library)
+        state.queue = []
+        state.current = None
+        state.fill_queue(queue)
+
+    def get(self, url):
+        start = time.time()
+        response = self.client.get(url)
+        size = len(response.data)
+        assert response.status_code == 200, response.data
+        return {'seconds': time.time() - start, 'bytes': size}
+
+    def run(self, tracks, queue, requests, searches):
+        self.reset(tracks, queue)
+        db = self.db
+        results = {'tracks': tracks, 'queue': queue}
+
+        seconds, changes = timed(db.update_db_songs)
+        results['update_db_songs'] = {
+            'seconds': seconds,
+            'rows': len(changes['added']),
+            'rows_per_second': len(changes['added']) / seconds if seconds else None
+        }
+        seconds, changes = timed(db.update_db_songs)
+        results['update_db_songs_unchanged'] = {'seconds': seconds}
+
+        seconds, changes = timed(db.update_db_queue)
+        results['update_db_queue'] = {'seconds': seconds, 'rows': len(changes['inserted'])}
+        if queue:
+            state = self.mpd.state
+            with state.lock:
+                state.cmd_moveid(state.queue[-1]['id'], 0)
+            seconds, changes = timed(db.update_db_queue)
+            results['update_db_queue_move'] = {'seconds': seconds, 'rows': len(changes['moved'])}
+
+        prefix = self.server.api_prefix
+        results['emberify'] = {
+            'songs': self.get(prefix + '/songs?stream=1'),
+            'songs_page': self.get(prefix + '/songs'),
+            'artists': self.get(prefix + '/artists?stream=1'),
+            'albums': self.get(prefix + '/albums?stream=1'),
+            'queue': self.get(prefix + '/queue')
+        }
+
+        latencies = []
+        for i in range(requests):
+            data = json.dumps({'queue': {'song': i % tracks + 1}})
+            seconds, response = timed(self.client.post, prefix + '/queue',
+                data=data, content_type='application/json')
+            assert response.status_code == 200, response.data
+            latencies.append(seconds)
+        results['post_queue'] = {
+            'requests': requests,
+            'mean': sum(latencies) / len(latencies),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99)
+        }
+
+        results['search'] = {}
+        for text in self.search_queries:
+            latencies = [timed(self.search_index.search, text, settings.search_limit)[0]
+                for i in range(searches)]
+            results['search'][text] = {
+                'p50': percentile(latencies, 50),
+                'p99': percentile(latencies, 99)
+            }
+
+        results['peak_memory_mb'] = peak_memory_mb()
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tracks', default='1000,10000',
+        help='comma separated library sizes, up to 500000')
+    parser.add_argument('--queue', type=int, default=200, help='queue length')
+    parser.add_argument('--requests', type=int, default=50,
+        help='number of POST /queue requests to time')
+    parser.add_argument('--searches', type=int, default=20,
+        help='number of times to time each search query')
+    parser.add_argument('-o', '--output', default='bench.json')
+    args = parser.parse_args()
+
+    fake_mpd = FakeMPD().start()
+    settings.mpd_server = 'localhost'
+    settings.mpd_port = fake_mpd.port
+    settings.db_uri = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    settings.db_clear_on_load = False
+
+    bench = Bench(fake_mpd)
+    runs = []
+    for tracks in [int(size) for size in args.tracks.split(',')]:
+        print 'Benchmarking {} tracks'.format(tracks)
+        runs.append(bench.run(tracks, min(args.queue, tracks), args.requests, args.searches))
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'time': time.time(),
+            'runs': runs
+        }, output, indent=2, sort_keys=True)
+    print 'Wrote {}'.format(args.output)
+
+
+if __name__ == '__main__':
+    main()
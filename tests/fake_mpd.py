@@ -0,0 +1,317 @@
+"""
+An in-process stand-in for MPD that speaks enough of the protocol for
+shitstream: library listing, the queue, database updates and idle.  Used
+by the benchmarks so they don't need a real MPD or real music.
+"""
+import select
+import shlex
+import SocketServer
+import threading
+import time
+
+
+def generate_library(tracks):
+    """Synthetic library, 10 songs to an album and 10 albums to an artist"""
+    library = []
+    for i in xrange(tracks):
+        album = i // 10
+        artist = album // 10
+        library.append({
+            'file': 'artist{0}/album{1}/{2:02d}-song{3}.mp3'.format(artist, album, i % 10 + 1, i),
+            'last-modified': '2014-08-24T00:00:00Z',
+            'time': str(120 + i % 300),
+            'artist': 'Artist {}'.format(artist),
+            'albumartist': 'Artist {}'.format(artist),
+            'album': 'Album {}'.format(album),
+            'title': 'Song {}'.format(i),
+            'track': str(i % 10 + 1),
+            'date': str(1970 + album % 45)
+        })
+    return library
+
+
+class MPDError(Exception):
+    def __init__(self, code, command, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.command = command
+
+
+class FakeMPDState(object):
+
+    def __init__(self, library=None):
+        self.lock = threading.Condition()
+        self.library = library or []
+        self.files = dict((song['file'], song) for song in self.library)
+        self.queue = []
+        self.next_id = 1
+        self.version = 1
+        self.current = None
+        self.state = 'stop'
+        self.job = 0
+        self.db_update = int(time.time())
+        self.idlers = []
+
+    def notify(self, *subsystems):
+        with self.lock:
+            for pending in self.idlers:
+                pending.update(subsystems)
+            self.lock.notify_all()
+
+    def changed(self, start):
+        """Bump the playlist version, marking entries from `start` changed"""
+        self.version += 1
+        for pos, entry in enumerate(self.queue):
+            if pos >= start:
+                entry['version'] = self.version
+        self.notify('playlist')
+
+    def entry(self, pos):
+        entry = self.queue[pos]
+        data = dict(self.files[entry['file']])
+        data.update({'pos': str(pos), 'id': str(entry['id'])})
+        return data
+
+    def find(self, song_id):
+        for pos, entry in enumerate(self.queue):
+            if entry['id'] == int(song_id):
+                return pos
+        raise MPDError(50, 'playlistid', 'No such song')
+
+    def add(self, uri, pos=None):
+        if uri not in self.files:
+            raise MPDError(50, 'addid', 'No such song')
+        entry = {'id': self.next_id, 'file': uri, 'version': self.version}
+        self.next_id += 1
+        if pos is None:
+            pos = len(self.queue)
+        self.queue.insert(pos, entry)
+        self.changed(pos)
+        return entry['id']
+
+    def fill_queue(self, length):
+        for song in self.library[:length]:
+            entry = {'id': self.next_id, 'file': song['file'], 'version': self.version}
+            self.next_id += 1
+            self.queue.append(entry)
+        self.changed(0)
+
+    # Commands, each returns a list of (key, value) pairs
+
+    def cmd_ping(self):
+        return []
+
+    def cmd_status(self):
+        status = [
+            ('volume', '100'),
+            ('playlist', str(self.version)),
+            ('playlistlength', str(len(self.queue))),
+            ('state', self.state)
+        ]
+        if self.current is not None and self.current < len(self.queue):
+            status.extend([
+                ('song', str(self.current)),
+                ('songid', str(self.queue[self.current]['id'])),
+                ('elapsed', '0.000')
+            ])
+        return status
+
+    def cmd_stats(self):
+        return [
+            ('artists', str(len(set(song.get('artist') for song in self.library)))),
+            ('albums', str(len(set(song.get('album') for song in self.library)))),
+            ('songs', str(len(self.library))),
+            ('db_playtime', str(sum(int(song.get('time', 0)) for song in self.library))),
+            ('db_update', str(self.db_update))
+        ]
+
+    def cmd_currentsong(self):
+        if self.current is None or self.current >= len(self.queue):
+            return []
+        return self.entry(self.current).items()
+
+    def cmd_listallinfo(self, uri=None):
+        pairs = []
+        for song in self.library:
+            if uri and not song['file'].startswith(uri):
+                continue
+            pairs.append(('file', song['file']))
+            pairs.extend((key, val) for key, val in song.iteritems() if key != 'file')
+        return pairs
+
+    def entries(self, positions):
+        pairs = []
+        for pos in positions:
+            entry = self.entry(pos)
+            pairs.append(('file', entry.pop('file')))
+            pairs.extend(entry.items())
+        return pairs
+
+    def cmd_playlistinfo(self):
+        return self.entries(range(len(self.queue)))
+
+    def cmd_plchanges(self, version):
+        version = int(version)
+        return self.entries(pos for pos, entry in enumerate(self.queue)
+            if entry['version'] > version)
+
+    def cmd_playlistid(self, song_id=None):
+        if song_id is None:
+            return self.cmd_playlistinfo()
+        return self.entries([self.find(song_id)])
+
+    def cmd_addid(self, uri, pos=None):
+        return [('Id', str(self.add(uri, pos if pos is None else int(pos))))]
+
+    def cmd_deleteid(self, song_id):
+        pos = self.find(song_id)
+        del self.queue[pos]
+        if self.current is not None and pos < self.current:
+            self.current -= 1
+        self.changed(pos)
+        return []
+
+    def cmd_moveid(self, song_id, to):
+        pos = self.find(song_id)
+        to = int(to)
+        self.queue.insert(to, self.queue.pop(pos))
+        self.changed(min(pos, to))
+        return []
+
+    def cmd_playid(self, song_id=None):
+        self.current = self.find(song_id) if song_id is not None else 0
+        self.state = 'play'
+        self.notify('player')
+        return []
+
+    def cmd_clear(self):
+        self.queue = []
+        self.current = None
+        self.changed(0)
+        return []
+
+    def cmd_update(self, uri=None):
+        # Updates finish instantly, there's nothing to scan
+        self.job += 1
+        # Seconds since the epoch, but each update has to show up
+        self.db_update = max(int(time.time()), self.db_update + 1)
+        self.notify('update', 'database')
+        return [('updating_db', str(self.job))]
+
+    def run(self, command, args):
+        method = getattr(self, 'cmd_' + command, None)
+        if not method:
+            raise MPDError(5, command, 'unknown command "{}"'.format(command))
+        with self.lock:
+            return method(*args)
+
+
+class FakeMPDHandler(SocketServer.StreamRequestHandler):
+    # Buffer replies and flush once per response, line by line sends stall
+    # multi-line replies on Nagle and delayed ACKs
+    wbufsize = -1
+
+    def write_pairs(self, pairs):
+        for key, val in pairs:
+            self.wfile.write(u'{}: {}\n'.format(key, val).encode('utf-8'))
+
+    def handle(self):
+        state = self.server.state
+        # Changes are remembered between idles, like MPD does
+        self.pending = set()
+        with state.lock:
+            state.idlers.append(self.pending)
+        try:
+            self.serve(state)
+        finally:
+            with state.lock:
+                state.idlers = [pending for pending in state.idlers
+                    if pending is not self.pending]
+
+    def serve(self, state):
+        self.wfile.write('OK MPD 0.18.0\n')
+        self.wfile.flush()
+        command_list = None
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            parts = shlex.split(line.strip())
+            if not parts:
+                continue
+            command, args = parts[0], parts[1:]
+
+            if command == 'close':
+                break
+            if self.server.latency and command not in ('idle', 'noidle'):
+                time.sleep(self.server.latency)
+
+            if command == 'command_list_ok_begin':
+                command_list = []
+                continue
+            elif command == 'command_list_end':
+                try:
+                    for command, args in command_list:
+                        self.write_pairs(state.run(command, args))
+                        self.wfile.write('list_OK\n')
+                    self.wfile.write('OK\n')
+                except MPDError as error:
+                    self.wfile.write('ACK [{}@0] {{{}}} {}\n'.format(
+                        error.code, error.command, error))
+                command_list = None
+            elif command_list is not None:
+                command_list.append((command, args))
+            elif command == 'idle':
+                self.idle(state, set(args))
+            elif command == 'noidle':
+                continue
+            else:
+                try:
+                    self.write_pairs(state.run(command, args))
+                    self.wfile.write('OK\n')
+                except MPDError as error:
+                    self.wfile.write('ACK [{}@0] {{{}}} {}\n'.format(
+                        error.code, error.command, error))
+            self.wfile.flush()
+
+    def idle(self, state, subsystems):
+        while True:
+            with state.lock:
+                changed = self.pending & subsystems if subsystems else set(self.pending)
+                if changed:
+                    self.pending.difference_update(changed)
+                    break
+                state.lock.wait(0.05)
+            # A noidle from the client ends the idle early
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                self.rfile.readline()
+                break
+        self.write_pairs(('changed', subsystem) for subsystem in sorted(changed))
+        self.wfile.write('OK\n')
+
+
+class FakeMPD(SocketServer.ThreadingTCPServer):
+    """
+    Serves `library` on localhost, port 0 picks a free port.  Each command
+    takes at least `latency` seconds, like a busy MPD would.  Call start()
+    to serve from a background thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, library=None, port=0, latency=0):
+        SocketServer.ThreadingTCPServer.__init__(self, ('localhost', port), FakeMPDHandler)
+        self.state = FakeMPDState(library)
+        self.latency = latency
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
@@ -0,0 +1,285 @@
+"""
+Load test for the async server mode: runs the server against a fake MPD
+with per-command latency, then hits it with concurrent REST requests
+while Socket.IO clients connect and wait for their first event.  Each
+mode gets its own server process:
+
+    python tests/load.py --modes threads,gevent -o load.json
+
+`overlap` is the summed request time over the wall clock time, how many
+requests were in flight at once.  Flask-SocketIO patches sockets in both
+modes, so both overlap MPD calls.
+
+Then every song in the library changes and readers keep requesting while
+the server syncs it.  That's where gevent mode differs: it writes the sync
+from a real thread, see concurrency.py, where the default mode stops
+answering until the whole sync is written.
+"""
+import argparse
+import json
+import os.path
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, parent)
+
+from bench import percentile
+from fake_mpd import FakeMPD, generate_library
+
+config = """
+[general]
+debug = false
+async_mode = {mode}
+port = {port}
+
+[mpd]
+server = localhost
+port = {mpd_port}
+
+[db]
+uri = sqlite:///{db}
+
+[icecast]
+url = http://127.0.0.1:1/status-json.xsl
+poll_interval = 60
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class SocketIOClient(object):
+    """Just enough of the Socket.IO 0.9 xhr-polling transport to connect"""
+
+    def __init__(self, base):
+        self.base = base
+
+    def request(self, path, data=None):
+        url = '{}/socket.io/1/{}?t={}'.format(self.base, path, int(time.time() * 1000))
+        return urllib2.urlopen(url, data, timeout=30).read().decode('utf-8')
+
+    def packets(self, body):
+        # Several packets come framed as \ufffd<length>\ufffd<packet>
+        if not body.startswith(u'\ufffd'):
+            return [body]
+        parts = body.split(u'\ufffd')
+        return parts[2::2]
+
+    def wait_for_event(self, namespace, name):
+        """Connect to `namespace`, returning seconds until event `name` arrives"""
+        start = time.time()
+        sid = self.request('').split(':')[0]
+        transport = 'xhr-polling/' + sid
+        # The first poll opens the transport, anything posted before is lost
+        self.request(transport)
+        self.request(transport, '1::' + namespace)
+        while True:
+            for packet in self.packets(self.request(transport)):
+                # type:id:endpoint:data
+                fields = packet.split(':', 3)
+                if fields[0] == '5' and json.loads(fields[3]).get('name') == name:
+                    return time.time() - start
+
+
+def sync_cycles(base):
+    """How many library syncs the server has finished"""
+    text = urllib2.urlopen(base + '/api/v1.0/metrics', timeout=60).read()
+    found = re.search(r'sync_cycle_seconds_count\{loop="songs"\} (\d+)', text)
+    return int(found.group(1)) if found else 0
+
+
+def wait_for_sync(base, cycles):
+    while sync_cycles(base) < cycles:
+        time.sleep(0.2)
+
+
+def run_server(mode, mpd_port, workdir):
+    port = free_port()
+    path = os.path.join(workdir, '{}.conf'.format(mode))
+    with open(path, 'w') as f:
+        f.write(config.format(mode=mode, port=port, mpd_port=mpd_port,
+            db=os.path.join(workdir, '{}.db'.format(mode))))
+    env = dict(os.environ, SHITSTREAM_CONFIG=path)
+    with open(os.path.join(workdir, '{}.log'.format(mode)), 'w') as log:
+        process = subprocess.Popen([sys.executable, 'server.py'], cwd=parent, env=env,
+            stdout=log, stderr=subprocess.STDOUT)
+
+    base = 'http://127.0.0.1:{}'.format(port)
+    for i in range(300):
+        try:
+            urllib2.urlopen(base + '/api/v1.0/metrics', timeout=1).read()
+            return process, base
+        except (urllib2.URLError, socket.error):
+            time.sleep(0.1)
+    process.kill()
+    raise Exception('Server in {} mode did not start'.format(mode))
+
+
+def load(base, clients, workers, requests, tracks):
+    latencies = []
+    socket_latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def rest(worker):
+        for i in range(requests):
+            data = json.dumps({'queue': {'song': (worker * requests + i) % tracks + 1}})
+            request = urllib2.Request(base + '/api/v1.0/queue', data,
+                {'Content-Type': 'application/json'})
+            start = time.time()
+            try:
+                urllib2.urlopen(request, timeout=60).read()
+                urllib2.urlopen(base + '/api/v1.0/queue', timeout=60).read()
+            except Exception as error:
+                with lock:
+                    errors.append(str(error))
+                continue
+            with lock:
+                latencies.append(time.time() - start)
+
+    def listen():
+        try:
+            seconds = SocketIOClient(base).wait_for_event('/api/v1.0/events/', 'hello')
+        except Exception as error:
+            with lock:
+                errors.append(str(error))
+            return
+        with lock:
+            socket_latencies.append(seconds)
+
+    threads = [threading.Thread(target=rest, args=(i,)) for i in range(workers)]
+    threads += [threading.Thread(target=listen) for i in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+
+    result = {'seconds': wall, 'errors': len(errors), 'error_samples': errors[:5]}
+    if latencies:
+        result['rest'] = {
+            'requests': len(latencies),
+            'per_second': len(latencies) / wall,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'overlap': sum(latencies) / wall
+        }
+    if socket_latencies:
+        result['socketio'] = {
+            'clients': len(socket_latencies),
+            'p50': percentile(socket_latencies, 50),
+            'p99': percentile(socket_latencies, 99)
+        }
+    return result
+
+
+def reads_during_sync(base, fake_mpd, readers, pause):
+    """Change every song, then time reads until the server has synced them"""
+    urls = ['/api/v1.0/listeners', '/api/v1.0/queue', '/api/v1.0/artists/1']
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    syncing = threading.Event()
+    syncing.set()
+
+    def read(url):
+        while syncing.is_set():
+            start = time.time()
+            try:
+                urllib2.urlopen(base + url, timeout=600).read()
+            except Exception as error:
+                with lock:
+                    errors.append(str(error))
+            else:
+                with lock:
+                    latencies.append(time.time() - start)
+            time.sleep(pause)
+
+    cycles = sync_cycles(base)
+    state = fake_mpd.state
+    modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    with state.lock:
+        for song in state.library:
+            song['last-modified'] = modified
+        state.cmd_update()
+
+    threads = [threading.Thread(target=read, args=(urls[i % len(urls)],))
+        for i in range(readers)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    wait_for_sync(base, cycles + 1)
+    seconds = time.time() - start
+    syncing.clear()
+    for thread in threads:
+        thread.join()
+
+    result = {'sync_seconds': seconds, 'errors': len(errors), 'error_samples': errors[:5]}
+    if latencies:
+        result.update({
+            'reads': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies)
+        })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--modes', default='threads,gevent')
+    parser.add_argument('--tracks', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.02,
+        help='seconds each fake MPD command takes')
+    parser.add_argument('--clients', type=int, default=50, help='Socket.IO clients')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent REST clients')
+    parser.add_argument('--requests', type=int, default=20, help='requests per REST client')
+    parser.add_argument('--readers', type=int, default=6, help='clients reading during a sync')
+    parser.add_argument('--pause', type=float, default=0.05,
+        help='seconds each reader waits between requests')
+    parser.add_argument('-o', '--output', default='load.json')
+    args = parser.parse_args()
+
+    fake_mpd = FakeMPD(generate_library(args.tracks), latency=args.latency).start()
+    workdir = tempfile.mkdtemp()
+    results = {}
+    for mode in args.modes.split(','):
+        print 'Load testing {} mode'.format(mode)
+        process, base = run_server(mode, fake_mpd.port, workdir)
+        try:
+            # Let the first library sync finish before measuring
+            wait_for_sync(base, 1)
+            results[mode] = load(base, args.clients, args.workers, args.requests, args.tracks)
+            results[mode]['during_sync'] = reads_during_sync(base, fake_mpd,
+                args.readers, args.pause)
+        finally:
+            process.terminate()
+            process.wait()
+        with fake_mpd.state.lock:
+            fake_mpd.state.cmd_clear()
+        print json.dumps(results[mode], indent=2, sort_keys=True)
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'time': time.time(),
+            'latency': args.latency,
+            'results': results
+        }, output, indent=2, sort_keys=True)
+    print 'Wrote {} (server logs in {})'.format(args.output, workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,38 @@
 import os.path
+import shutil
+import socket
 import sys
+import tempfile
 
 parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, parent)
 
 import server
+import time
+import threading
 import unittest
 import json
+import hashlib
+import zlib
+import BaseHTTPServer
 from jsonschema import validate
+from mpd import MPDClient
+from sqlalchemy import create_engine, event
+from autodj import AutoDJ, Window
+from cache import response_cache
+from cluster import Cluster, LoopbackBus
+from downloaders import playlist
+from downloaders.downloader import downloader
+from downloaders.soundcloud import soundcloud_downloader
+from downloaders.youtube import youtube_downloader
+from youtube_dl import YoutubeDL
+from youtube_dl.extractor.common import InfoExtractor
+from youtube_dl.utils import PagedList
+from events import EventLog
+from fake_mpd import FakeMPD
+from metrics import metrics
+from icecast import IcecastStats
+from search import search_index
 
 
 server.init()
@@ -28,6 +53,93 @@ def json_schema_test(schema_file):
     return json_schema_test_decorator
 
 
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the server's routes, JSON for dicts and lists, bytes with Range"""
+
+    def do_GET(self):
+        route = self.server.routes.get(self.path.split('?')[0])
+        if route is None:
+            self.send_error(404)
+            return
+        if not isinstance(route, str):
+            self.reply(200, json.dumps(route), 'application/json')
+            return
+
+        requested = self.headers.get('Range')
+        self.server.ranges.append(requested)
+        if requested:
+            start = int(requested.split('=')[1].rstrip('-'))
+            self.reply(206, route[start:], 'audio/mpeg')
+        else:
+            self.reply(200, route, 'audio/mpeg')
+
+    def reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StallHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Sends the headers, then stalls half way through the body"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '100')
+        self.end_headers()
+        self.wfile.write('{"icestats": ')
+        self.wfile.flush()
+        time.sleep(0.5)
+
+    # The poller gives up and hangs up long before we're done
+    def handle(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, routes, handler=StubHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', 0), handler)
+        self.routes = routes
+        self.ranges = []
+        self.url = 'http://localhost:{}'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class StubYoutubeIE(InfoExtractor):
+    """Lists YouTube users and playlists the way youtube-dl does, offline"""
+    _VALID_URL = r'https://www\.youtube\.com/(user/|playlist\?list=)'
+
+    videos = ['video-{}'.format(i) for i in range(5)]
+
+    def _real_extract(self, url):
+        entries = [self.url_result(video, 'Youtube', video_id=video) for video in self.videos]
+        if '/user/' in url:
+            # Two videos to a page
+            return self.playlist_result(PagedList(
+                lambda page: entries[page * 2:page * 2 + 2], 2), 'stub')
+        return self.playlist_result(entries, 'stub')
+
+
 class MainTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -53,6 +165,55 @@ class MainTestCase(unittest.TestCase):
     def test_queue(self):
         return self.client.get('/api/v1.0/queue')
 
+    @json_schema_test('tests/fixtures/queue.schema.json')
+    def test_queue_album(self):
+        return self.client.post('/api/v1.0/queue/bulk',
+            data=json.dumps({'album': 1}), content_type='application/json')
+
+    def test_conditional_get(self):
+        response_cache.update('library', 'conditional get test')
+        headers = {'Accept-Encoding': 'gzip'}
+        response = self.client.get('/api/v1.0/artists', headers=headers)
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'artists' in json.loads(zlib.decompress(response.data, 16 + zlib.MAX_WBITS))
+
+        headers['If-None-Match'] = response.headers['ETag']
+        # Unbuffered, the debugger middleware ends an empty body before the
+        # test client sees the status
+        response = self.client.get('/api/v1.0/artists', headers=headers, buffered=True)
+        assert response.status_code == 304
+
+    def test_error_status_counted(self):
+        key = metrics.key('http_requests_total',
+            {'endpoint': 'add_songs_to_queue', 'status': 400})
+        before = metrics.counters.get(key, 0)
+        response = self.client.post('/api/v1.0/queue/bulk', data='{}',
+            content_type='application/json')
+        assert response.status_code == 400
+        assert metrics.counters.get(key, 0) == before + 1
+
+    def test_search(self):
+        # Fixture mp3s include "Le Long de la rivi\xe8re Tendre", accented
+        response = self.client.get('/api/v1.0/search?q=riviere%20te')
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data['meta']['query'] == 'riviere te'
+        assert len(data['songs']) == 1
+
+    def test_search_one_letter(self):
+        # A one letter prefix would match nearly everything
+        assert search_index.match_query(search_index.words('Le S')) == u'"le" "s"'
+        assert search_index.match_query(search_index.words('Le So')) == u'"le" "so"*'
+        response = self.client.get('/api/v1.0/search?q=s')
+        assert response.status_code == 200
+
+    def test_search_without_index(self):
+        db = server.db
+        song_id, name = db.db.session.query(db.Song.id, db.Song.name).\
+            filter(db.Song.name != None).first()
+        assert song_id in search_index.search_like(name, 50)
+
 
 class AddURLTestCase(unittest.TestCase):
 
@@ -64,11 +225,17 @@ class AddURLTestCase(unittest.TestCase):
     def tearDown(self):
         pass
 
-    def process_event(self, received=None):
+    def process_event(self, received=None, timeout=600):
+        # Downloads run on a worker, so keep polling until something arrives
+        start = time.time()
         if not received or not len(received):
             if not getattr(self, '_received', None):
-                self._received = self.client.get_received(self.namespace)
+                self._received = []
             received = self._received
+        while not len(received) and time.time() - start < timeout:
+            received.extend(self.client.get_received(self.namespace))
+            if not len(received):
+                time.sleep(0.1)
         if len(received) > 0:
             return received.pop(0)
         return None
@@ -99,6 +266,8 @@ class AddURLTestCase(unittest.TestCase):
         msg = self.process_event()
         assert msg['args'][0]['msg'] == 'URL appears to be valid'
         msg = self.process_event()
+        assert msg['args'][0]['msg'] == 'Download queued'
+        msg = self.process_event()
         assert msg['args'][0]['msg'] == 'Starting youtube-dl'
 
         added = False
@@ -115,5 +284,522 @@ class AddURLTestCase(unittest.TestCase):
         assert msg['args'][0]['msg'] == 'Song queued'
 
 
+class PlaylistTestCase(unittest.TestCase):
+
+    def test_fetch_all(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        received = []
+
+        def handler(item, emit):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            emit('response', {'msg': 'Fetching'})
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            if item == 'bad':
+                raise Exception('Not found')
+            return item.upper()
+
+        items = ['a', 'bad', 'c', 'd', 'e']
+        results, errors = playlist.fetch_all(items, handler, 2,
+            lambda event, data: received.append(data))
+        assert results == ['A', None, 'C', 'D', 'E']
+        assert [bool(error) for error in errors] == [False, True, False, False, False]
+        assert running[1] == 2
+        assert {'msg': '[2/5] Not found', 'item': 2, 'total': 5} in received
+        assert len([data for data in received if data['msg'].endswith('Fetching')]) == 5
+
+    def test_soundcloud_set(self):
+        tracks = [{'permalink_url': 'https://soundcloud.com/someone/track-{}'.format(i)}
+            for i in range(3)]
+        fixture = StubServer({'/resolve.json': {'kind': 'playlist', 'tracks': tracks}})
+
+        downloader = soundcloud_downloader()
+        downloader.api_url = fixture.url
+        single = 'https://soundcloud.com/someone/track-0'
+        assert downloader.expand(single) == [single]
+        urls = downloader.expand('https://soundcloud.com/someone/sets/things')
+        fixture.shutdown()
+        assert urls == [track['permalink_url'] for track in tracks]
+
+
+    def test_youtube_playlists(self):
+        def client(params=None):
+            client = YoutubeDL({'quiet': True})
+            client.add_info_extractor(StubYoutubeIE())
+            return client
+        downloader = youtube_downloader()
+        downloader.client = client
+
+        video = 'https://www.youtube.com/watch?v=video-0'
+        assert downloader.expand(video) == [video]
+        urls = [downloader.video_url.format(video) for video in StubYoutubeIE.videos]
+        assert downloader.expand('https://www.youtube.com/playlist?list=stub') == urls
+        assert downloader.expand('https://www.youtube.com/user/someone') == urls
+
+
+class SoundcloudTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.audio = ''.join(chr(i % 256) for i in range(300000))
+        self.fixture = StubServer({'/stream': self.audio})
+        self.fixture.routes['/resolve.json'] = {
+            'kind': 'track', 'id': 42, 'title': 'Some/Song',
+            'stream_url': self.fixture.url + '/stream'
+        }
+        self.downloader = soundcloud_downloader()
+        self.downloader.api_url = self.fixture.url
+        self.target = tempfile.mkdtemp()
+        self.received = []
+
+    def tearDown(self):
+        self.fixture.shutdown()
+        shutil.rmtree(self.target)
+
+    def fetch(self):
+        return self.downloader.fetch('https://soundcloud.com/someone/some-song',
+            self.target, lambda event, data: self.received.append(data))
+
+    def test_fetch(self):
+        filename = self.fetch()
+        assert os.path.basename(filename) == 'Some_Song-42.mp3'
+        assert open(filename, 'rb').read() == self.audio
+        assert self.received[-1]['msg'] == 'Download finished'
+        assert self.received[-2]['done'] == len(self.audio)
+        assert self.fixture.ranges == [None]
+
+    def test_resume(self):
+        partial = os.path.join(self.target, 'Some_Song-42.mp3.part')
+        with open(partial, 'wb') as f:
+            f.write(self.audio[:1000])
+        filename = self.fetch()
+        assert open(filename, 'rb').read() == self.audio
+        assert self.received[0]['msg'] == 'Resuming download'
+        assert self.fixture.ranges == ['bytes=1000-']
+
+
+class IcecastTestCase(unittest.TestCase):
+
+    def test_stalled(self):
+        fixture = StubServer({}, StallHandler)
+        changes = []
+        stats = IcecastStats(fixture.url + '/status-json.xsl', 0.05, 60, 0.1,
+            on_change=changes.append)
+        stats.start()
+        time.sleep(0.6)
+        assert stats.thread.is_alive()
+        assert stats.current() is None
+
+        # Once Icecast answers again so does the poller
+        fixture.shutdown()
+        fixture = StubServer({'/status-json.xsl': {'icestats': {'source': {
+            'listenurl': 'http://localhost:8000/stream.mp3', 'listeners': 3}}}})
+        stats.url = fixture.url + '/status-json.xsl'
+        time.sleep(0.6)
+        fixture.shutdown()
+        assert stats.current()['listeners'] == 3
+        assert changes[-1]['mounts']['/stream.mp3']['listeners'] == 3
+
+    def test_connect(self):
+        namespace = '/api/v1.0/listeners/'
+        client = server.socketio.test_client(server.app, namespace=namespace)
+        received = client.get_received(namespace)
+        assert received[0]['name'] == 'listeners'
+        assert 'listeners' in received[0]['args'][0]
+
+
+class QueryCountTestCase(unittest.TestCase):
+
+    urls = ['/api/v1.0/artists', '/api/v1.0/albums', '/api/v1.0/songs',
+        '/api/v1.0/queue', '/api/v1.0/artists/1']
+
+    def setUp(self):
+        server.app.config['TESTING'] = True
+        self.client = server.app.test_client()
+        # Count what it takes to build the responses, not to serve them
+        server.settings.cache_enabled = False
+
+    def tearDown(self):
+        server.settings.cache_enabled = True
+        db = server.db
+        session = db.db.session
+        artists = [artist_id for artist_id, in session.query(db.Artist.id).filter(
+            db.Artist.name.like('Query count %'))]
+        if artists:
+            db.Song.query.filter(db.Song.artist_id.in_(artists)).delete(synchronize_session=False)
+            db.Album.query.filter(db.Album.artist_id.in_(artists)).delete(synchronize_session=False)
+            db.Artist.query.filter(db.Artist.id.in_(artists)).delete(synchronize_session=False)
+        session.commit()
+
+    def add_artists(self, start, count):
+        db = server.db
+        session = db.db.session
+        for i in range(start, start + count):
+            artist = db.Artist(name='Query count {}'.format(i))
+            session.add(artist)
+            session.flush()
+            album = db.Album(name='Album', artist_id=artist.id)
+            session.add(album)
+            session.flush()
+            session.add(db.Song(uri='query-count/{}/1.mp3'.format(i),
+                artist_id=artist.id, album_id=album.id))
+            session.add(db.Song(uri='query-count/{}/2.mp3'.format(i), artist_id=artist.id))
+        session.commit()
+
+    def count_queries(self):
+        counts = {}
+        for url in self.urls:
+            queries = []
+            listener = lambda *args: queries.append(args[2])
+            event.listen(server.db.db.engine, 'before_cursor_execute', listener)
+            try:
+                response = self.client.get(url)
+            finally:
+                event.remove(server.db.db.engine, 'before_cursor_execute', listener)
+            assert response.status_code == 200, response.data
+            counts[url] = len(queries)
+        return counts
+
+    def test_query_count(self):
+        self.add_artists(0, 5)
+        small = self.count_queries()
+        self.add_artists(5, 100)
+        large = self.count_queries()
+        assert small == large, (small, large)
+
+
+class StubDownloader(downloader):
+    """Fetches the same bytes from every URL, only /plain ones have no source id"""
+
+    audio = 'dedup test audio'
+
+    def source_id(self, url):
+        if '/plain/' in url:
+            return None
+        return 'stub:' + url.rsplit('/', 1)[-1]
+
+    def fetch(self, url, target, emit):
+        filename = os.path.join(target, 'dedup-test.m4a')
+        with open(filename, 'wb') as f:
+            f.write(self.audio)
+        return filename
+
+    def __unicode__(self):
+        return 'stub'
+
+
+class DedupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        db = server.db
+        self.download_dir = server.settings.download_dir
+        server.settings.download_dir = tempfile.mkdtemp()
+        self.digest = hashlib.sha1(StubDownloader.audio).hexdigest()
+        self.song_id, self.uri = db.db.session.query(db.Song.id, db.Song.uri).first()
+        db.db.session.add(db.DownloadSource(source='stub:first', content_hash=self.digest,
+            uri=self.uri, size=1000))
+        db.db.session.commit()
+        self.received = []
+
+    def tearDown(self):
+        db = server.db
+        shutil.rmtree(server.settings.download_dir)
+        server.settings.download_dir = self.download_dir
+        db.DownloadSource.query.filter_by(content_hash=self.digest).\
+            delete(synchronize_session=False)
+        db.db.session.commit()
+
+    def entries(self):
+        db = server.db
+        db.db.session.expire_all()
+        return dict((entry.source, entry.hits) for entry in
+            db.DownloadSource.query.filter_by(content_hash=self.digest))
+
+    def download(self, url):
+        return server.pipeline.run(StubDownloader(), url,
+            lambda event, data: self.received.append(data))
+
+    def test_source_hit(self):
+        found = server.pipeline.lookup(StubDownloader(), 'http://stub/first')
+        assert found == (self.song_id, self.uri)
+        assert self.entries() == {'stub:first': 1}
+        assert server.pipeline.lookup(StubDownloader(), 'http://stub/other') is None
+
+    def test_content_hit(self):
+        assert self.download('http://stub/second') == (self.song_id, self.uri)
+        assert self.received[-1]['msg'] == 'Song already downloaded from another URL'
+        assert os.listdir(os.path.join(server.settings.download_dir, '.fetch')) == []
+        # Next time the new URL is a source hit
+        assert self.entries() == {'stub:first': 1, 'stub:second': 0}
+
+        # Nothing new to remember without a source id
+        assert self.download('http://stub/plain/third') == (self.song_id, self.uri)
+        assert self.download('http://stub/plain/third') == (self.song_id, self.uri)
+        assert self.entries() == {'stub:first': 3, 'stub:second': 0}
+        assert server.pipeline.dedup_stats()['entries'] >= 2
+
+
+class SyncSongsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        db = server.db
+        # What MPD already has stays as it is
+        self.library = [{'file': uri, 'last-modified': last_modified}
+            for uri, last_modified in db.db.session.query(db.Song.uri, db.Song.last_modified)]
+        self.songs = [{
+            'file': 'sync-test/{}.mp3'.format(i),
+            'last-modified': '2014-08-24T00:00:00Z',
+            'title': 'Sync test {}'.format(i),
+            'artist': 'Sync test',
+            'album': 'Sync test'
+        } for i in range(3)]
+
+    def tearDown(self):
+        db = server.db
+        db.Song.query.filter(db.Song.uri.like('sync-test/%')).delete(synchronize_session=False)
+        artist = db.Artist.query.filter_by(name='Sync test').first()
+        if artist:
+            db.Album.query.filter_by(artist_id=artist.id).delete(synchronize_session=False)
+            db.Artist.query.filter_by(id=artist.id).delete(synchronize_session=False)
+        db.db.session.commit()
+        db.reset_identity_caches()
+
+    def sync(self, songs):
+        return server.db.writer.run(server.db.sync_songs, self.library + songs, 2)
+
+    def test_changes(self):
+        db = server.db
+        changes = self.sync(self.songs)
+        ids = [db.song_ids.get(song['file']) for song in self.songs]
+        assert None not in ids
+        assert changes == {'added': ids, 'updated': [], 'removed': []}
+        assert self.sync(self.songs) == {'added': [], 'updated': [], 'removed': []}
+
+        changed = dict(self.songs[1], title='Changed')
+        changed['last-modified'] = '2014-08-25T00:00:00Z'
+        changes = self.sync([self.songs[0], changed])
+        assert changes == {'added': [], 'updated': [ids[1]], 'removed': [ids[2]]}
+        assert db.Song.query.get(ids[1]).name == 'Changed'
+        assert db.Song.query.get(ids[2]) is None
+        assert db.song_ids.get(self.songs[2]['file']) is None
+
+
+class QueueMirrorTestCase(unittest.TestCase):
+    """Mirrors a fake MPD's queue through its plchanges"""
+
+    def setUp(self):
+        db = server.db
+        uris = [uri for uri, in db.db.session.query(db.Song.uri).limit(5)]
+        self.song_ids = dict((uri, db.song_ids.get(uri)) for uri in uris)
+        self.fake = FakeMPD([{'file': uri} for uri in uris]).start()
+        self.mpdc = MPDClient(use_unicode=True)
+        self.mpdc.connect('localhost', self.fake.port)
+        self.mirror = db.QueueMirror()
+        self.client_view = {}
+
+    def tearDown(self):
+        self.mpdc.disconnect()
+        self.fake.shutdown()
+        # Mirror the real queue again
+        server.db.queue_mirror.version = None
+        server.db.update_db_queue()
+
+    def sync(self):
+        """Sync and check the table, and what a client applying the deltas sees"""
+        db = server.db
+        changes = self.mirror.sync(self.mpdc)
+        expected = [(int(entry['id']), int(entry['pos']), self.song_ids[entry['file']])
+            for entry in self.mpdc.playlistinfo()]
+        table = [(row.id, row.pos, row.song_id)
+            for row in db.Queue.query.order_by(db.Queue.pos)]
+        assert table == expected, (table, expected)
+
+        for queue_id in changes['deleted']:
+            del self.client_view[queue_id]
+        for entry in changes['inserted'] + changes['moved']:
+            self.client_view[entry['id']] = (entry['pos'], entry['song'])
+        view = sorted((pos, queue_id, song)
+            for queue_id, (pos, song) in self.client_view.iteritems())
+        assert [(queue_id, pos, song) for pos, queue_id, song in view] == expected
+        return changes
+
+    def test_changes(self):
+        state = self.fake.state
+        uris = state.files.keys()
+        with state.lock:
+            for uri in uris * 2:
+                state.add(uri)
+        changes = self.sync()
+        assert len(changes['inserted']) == len(uris) * 2
+        # Unchanged
+        assert self.sync()['inserted'] == []
+
+        with state.lock:
+            first = state.queue[0]['id']
+            added = state.add(uris[0], 1)
+        changes = self.sync()
+        assert [entry['id'] for entry in changes['inserted']] == [added]
+        assert first not in [entry['id'] for entry in changes['moved']]
+
+        with state.lock:
+            last = state.queue[-1]['id']
+            state.cmd_moveid(last, 0)
+            state.cmd_deleteid(state.queue[3]['id'])
+        changes = self.sync()
+        assert changes['inserted'] == []
+        assert len(changes['deleted']) == 1
+        assert changes['moved'][0] == {'id': last, 'pos': 0,
+            'song': self.song_ids[state.queue[0]['file']]}
+
+        # Deleting from the end leaves nothing for plchanges to report
+        with state.lock:
+            removed = [entry['id'] for entry in state.queue[-2:]]
+            state.cmd_deleteid(removed[0])
+            state.cmd_deleteid(removed[1])
+        changes = self.sync()
+        assert sorted(changes['deleted']) == sorted(removed)
+
+        with state.lock:
+            state.cmd_playid(state.queue[2]['id'])
+        self.sync()
+        db = server.db
+        played = [row.played for row in db.Queue.query.order_by(db.Queue.pos)]
+        assert played == [True, True] + [False] * (len(played) - 2)
+
+        with state.lock:
+            state.cmd_clear()
+        changes = self.sync()
+        assert changes['length'] == 0
+        assert self.client_view == {}
+
+
+class MigrationTestCase(unittest.TestCase):
+    # The schema before migrations were tracked
+    baseline = [
+        """CREATE TABLE artist (id INTEGER NOT NULL, name TEXT NOT NULL, name_alpha TEXT,
+            PRIMARY KEY (id), UNIQUE (name))""",
+        """CREATE TABLE album (id INTEGER NOT NULL, name TEXT NOT NULL, date VARCHAR(32),
+            artist_id INTEGER, PRIMARY KEY (id), UNIQUE (name))""",
+        """CREATE TABLE song (id INTEGER NOT NULL, uri TEXT NOT NULL, name TEXT, track INTEGER,
+            length INTEGER, artist_id INTEGER, album_id INTEGER, PRIMARY KEY (id), UNIQUE (uri))""",
+        """CREATE TABLE queue (id INTEGER NOT NULL, pos INTEGER, song_id INTEGER,
+            played BOOLEAN NOT NULL, PRIMARY KEY (id))"""
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///' + os.path.join(self.dir, 'old.db'))
+        for statement in self.baseline:
+            self.engine.execute(statement)
+        self.engine.execute("INSERT INTO song (uri) VALUES ('old.mp3')")
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def test_baseline(self):
+        server.db.migrate_sqlite(self.engine)
+        assert self.engine.execute('PRAGMA user_version').scalar() == len(server.db.migrations)
+        indexes = [name for name, in self.engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        assert 'ix_queue_pos' in indexes and 'ix_song_album_track' in indexes
+
+        # Steps that ran without being recorded don't redo their work
+        self.engine.execute("UPDATE song SET last_modified = 'synced'")
+        self.engine.execute('PRAGMA user_version = 0')
+        server.db.migrate_sqlite(self.engine)
+        assert self.engine.execute('SELECT last_modified FROM song').scalar() == 'synced'
+
+
+class AutoDJTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.attempts = server.settings.autodj_attempts
+        server.settings.autodj_attempts = 200
+        self.autodj = AutoDJ()
+        # 4 artists with 5 songs each, one album per artist
+        self.autodj.load([(i, 'song{}.mp3'.format(i), i // 5, i // 5) for i in range(20)])
+
+    def tearDown(self):
+        server.settings.autodj_attempts = self.attempts
+
+    def test_windows(self):
+        windows = (Window(20, [0]), Window(3, [0]), Window(0))
+        picks = self.autodj.pick(8, windows)
+        artists = [self.autodj.artists[i] for i in picks]
+        assert 0 not in picks
+        assert len(set(picks)) == 8
+        # No artist twice within any 4 picks in a row
+        for n in range(len(artists) - 3):
+            assert len(set(artists[n:n + 4])) == 4
+
+    def test_relaxed(self):
+        # Only 20 songs, so the song window has to give way
+        picks = self.autodj.pick(30, (Window(100), Window(3), Window(3)))
+        assert len(picks) == 30
+
+
+class EventLogTestCase(unittest.TestCase):
+
+    def test_restart(self):
+        before = EventLog(10)
+        for i in range(5):
+            before.publish('queue', {'inserted': [i]})
+        # A client of the old server comes back to a new one
+        after = EventLog(10)
+        after.publish('queue', {'inserted': [0]})
+        assert after.since(5) is None
+        assert after.since(0, before.epoch) is None
+        assert after.since(0, after.epoch) == after.since(0)
+        assert after.since(1, after.epoch) == []
+
+    def test_resume(self):
+        namespace = '/api/v1.0/events/'
+        client = server.socketio.test_client(server.app, namespace=namespace)
+        hello = client.get_received(namespace)[0]['args'][0]
+        client.emit('resume', {'seq': hello['seq'] + 5, 'epoch': hello['epoch']},
+            namespace=namespace)
+        received = client.get_received(namespace)
+        assert received[0]['name'] == 'reset'
+        assert received[0]['args'][0]['seq'] == hello['seq']
+
+
+class ClusterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bus = LoopbackBus()
+        self.owner = Cluster(self.bus, 'auto', 0.2)
+        self.reader = Cluster(self.bus, 'auto', 0.2)
+        self.reader.node = 'reader'
+
+    def test_election(self):
+        assert self.owner.renew()
+        assert not self.reader.renew()
+        # Owner stops renewing, lease runs out
+        time.sleep(0.3)
+        assert self.reader.renew()
+
+    def test_event_fan_out(self):
+        owner_log = EventLog(10)
+        reader_log = EventLog(10)
+        owner_log.send = lambda event: self.owner.publish('events', event)
+        def receive(event, origin):
+            if origin != self.reader.node:
+                reader_log.receive(event)
+        self.reader.subscribe('events', receive)
+
+        for i in range(3):
+            owner_log.publish('queue', {'inserted': [i]})
+        assert reader_log.seq == 3
+        assert reader_log.since(1) == owner_log.since(1)
+
+        # A gap means what the reader kept can't be replayed
+        reader_log.receive({'seq': 10, 'type': 'queue', 'data': {}})
+        assert reader_log.since(3) is None
+
+
 if __name__ == '__main__':
     unittest.main()